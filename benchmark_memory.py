@@ -0,0 +1,117 @@
+#!/bin/env python
+# Benchmark the memory used by a synthetic jigdo of 100k parts: parsing
+# it, creating a JigdoImageSlice for every part and picking a source
+# for each. For comparison, it also creates the same slices the way they
+# used to be kept, each with a __dict__ holding its own log, reactor and
+# settings references and full location, and a list of the sources
+# tried per file.
+
+import os, gc, time, base64, shutil, tempfile, resource
+
+from pyJigdo.jigdo import JigdoDefinition, JigdoImageSlice
+from pyJigdo.util import md5_hashlib
+
+from test_helpers import Log
+
+PARTS = 100000
+
+class Settings:
+    """ The settings a JigdoDefinition and its slices look at. """
+    no_jigdo_cache = True
+    servers_only = False
+    fallback_number = 3
+    max_download_attempts = 6
+
+class Async:
+    mirror_stats = None
+
+class DictSlice:
+    """ A slice as it used to be kept, for comparison. """
+    def __init__(self, log, async, settings, md5_sum, filename, repo,
+                 target_location, template, size=0, offset=0):
+        self.log = log
+        self.async = async
+        self.settings = settings
+        self.slice_sum = md5_sum
+        self.filename = filename
+        self.repo = repo
+        self.target_location = target_location
+        self.fs_location = os.path.join(target_location, filename)
+        self.fs_offset = None
+        self.template = template
+        self.size = size
+        self.offset = offset
+        self.current_source = None
+        self.download_tries = 0
+        self.finished = False
+        self.stuffing = False
+        self.in_image = False
+
+def memory():
+    """ Return the memory in use, in MB. """
+    try:
+        return int(open("/proc/self/statm").read().split()[1]) * \
+               resource.getpagesize() / float(1024 * 1024)
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def write_jigdo(location):
+    """ Write a jigdo with PARTS parts over two repos to location. """
+    f = open(location, "w")
+    f.write("[Jigdo]\nVersion=1.1\n\n"
+            "[Image]\nFilename=big.iso\nTemplate=http://example.com/big.template\n"
+            "Template-MD5Sum=AAAAAAAAAAAAAAAAAAAAAA\n\n"
+            "[Servers]\nFedora=http://mirror.example.com/fedora/\n"
+            "Fedora=http://mirror2.example.com/fedora/\n"
+            "Updates=http://mirror.example.com/updates/\n\n[Parts]\n")
+    for i in xrange(PARTS):
+        md5 = base64.urlsafe_b64encode(md5_hashlib.md5(str(i)).digest())[:22]
+        label = i % 5 and "Fedora" or "Updates"
+        f.write("%s=%s:Packages/%s/pkg-%s-1.0-1.fc12.i686.rpm\n" % \
+                (md5, label, chr(97 + i % 26), i))
+    f.close()
+
+def main():
+    storage = tempfile.mkdtemp()
+    try:
+        settings = Settings()
+        settings.download_target = storage
+        settings.download_storage = storage
+        jigdo = os.path.join(storage, "big.jigdo")
+        write_jigdo(jigdo)
+        gc.collect()
+        start = memory()
+        started = time.time()
+        definition = JigdoDefinition(Async(), Log(), settings, jigdo)
+        parsed = memory()
+        print "parse: %.1f s, %.0f MB" % (time.time() - started, parsed - start)
+
+        image = definition.images[1]
+        for (md5, (label, name)) in definition.parts.iteritems():
+            image.slices[md5] = JigdoImageSlice(md5, name, definition.servers.objects[label],
+                                                image, size=1000)
+        sliced = memory()
+        print "%s slices: %.0f MB" % (len(image.slices), sliced - parsed)
+        for jigdo_slice in image.slices.itervalues(): jigdo_slice.source()
+        sourced = memory()
+        print "picking their sources: %.0f MB" % (sourced - sliced)
+
+        log = Log()
+        async = Async()
+        old_slices = {}
+        for (md5, (label, name)) in definition.parts.iteritems():
+            old_slices[md5] = DictSlice(log, async, settings, md5, name,
+                                        definition.servers.objects[label],
+                                        storage, image, size=1000)
+        old_sliced = memory()
+        print "%s slices with a __dict__: %.0f MB" % (len(old_slices), old_sliced - sourced)
+        history = {}
+        for (md5, old_slice) in old_slices.iteritems():
+            history[old_slice.filename] = [old_slice.repo.baseurls[0]]
+            old_slice.current_source = image.slices[md5].current_source
+        print "and a list of sources tried per file: %.0f MB" % (memory() - old_sliced)
+    finally:
+        shutil.rmtree(storage)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/bin/env python
+# Benchmark parsing a synthetic jigdo of 100k parts, plain and gzipped,
+# with and without the [Parts] fast path. Reports the time per 10k parts.
+
+import os, gzip, time, shutil, tempfile
+
+from pyJigdo.jigdo import JigdoDefinition
+
+from benchmark_memory import PARTS, write_jigdo
+from test_helpers import Log
+
+RUNS = 3
+
+class Settings:
+    """ The settings the parser looks at. """
+    no_jigdo_cache = True
+
+class SlowPartsDefinition(JigdoDefinition):
+    """ Parse [Parts] like any other section. """
+    parts_fast_path = False
+
+def time_parse(definition_class, jigdo):
+    """ Return the best time to parse jigdo over RUNS runs, per 10k parts. """
+    best = None
+    for i in range(RUNS):
+        started = time.time()
+        definition = definition_class(None, Log(), Settings(), jigdo, just_print=True)
+        elapsed = time.time() - started
+        if best is None or elapsed < best: best = elapsed
+    assert len(definition.parts) == PARTS
+    return best / PARTS * 10000
+
+def main():
+    storage = tempfile.mkdtemp()
+    try:
+        Settings.download_target = storage
+        jigdo = os.path.join(storage, "big.jigdo")
+        write_jigdo(jigdo)
+        gzipped = "%s.gz" % jigdo
+        f = gzip.open(gzipped, "wb")
+        f.write(open(jigdo, "rb").read())
+        f.close()
+        for (name, location) in (("plain", jigdo), ("gzipped", gzipped)):
+            for (path, definition_class) in (("fast path", JigdoDefinition),
+                                             ("no fast path", SlowPartsDefinition)):
+                print "%s, %s: %.1f ms per 10k parts" % \
+                      (name, path, time_parse(definition_class, location) * 1000)
+    finally:
+        shutil.rmtree(storage)
+
+if __name__ == "__main__":
+    main()
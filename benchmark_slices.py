@@ -0,0 +1,71 @@
+#!/bin/env python
+# Benchmark the slice bookkeeping of a JigdoImage: how long it takes to
+# handle a slice finishing, with 5k and 50k slices. The cost per slice
+# should not grow with the number of slices. For comparison, it also
+# times rescanning every slice on each completion, which is what the
+# bookkeeping replaced.
+
+import time
+
+from twisted.internet import defer
+
+from pyJigdo.jigdo import JigdoImage, JigdoImageSlice
+
+from test_helpers import Log
+
+class Settings:
+    """ The settings a JigdoImage looks at. """
+    download_target = "/tmp"
+    download_storage = "/tmp"
+    download_stuff_bits = 80
+    download_stuff_then_remove = False
+
+class Stuffer:
+    """ A stuffing worker that takes batches and never finishes them,
+        so only the bookkeeping is timed. """
+    def submit(self, function, *args):
+        return defer.Deferred()
+
+    def full(self):
+        return False
+
+class Async:
+    stuffer = Stuffer()
+
+def make_image(count):
+    """ Return a JigdoImage with count missing slices. """
+    image = JigdoImage(Log(), Async(), Settings(), None)
+    for i in xrange(count):
+        md5 = "md5-%s" % i
+        image.slices[md5] = JigdoImageSlice(md5, "file-%s" % i, None, image, size=1)
+        image.missing[md5] = image.slices[md5]
+    return image
+
+def time_completions(count):
+    """ Return the seconds per slice to mark count slices as done. """
+    image = make_image(count)
+    started = time.time()
+    for jigdo_slice in image.slices.values():
+        jigdo_slice.data_complete()
+    elapsed = time.time() - started
+    assert not image.missing and len(image.slices) == count
+    return elapsed / count
+
+def time_rescans(count):
+    """ Return the seconds per slice to mark count slices as done when
+        every completion walks all slices to find the finished ones. """
+    image = make_image(count)
+    started = time.time()
+    for jigdo_slice in image.slices.values():
+        jigdo_slice.finished = True
+        ready = {}
+        for (md5, s) in image.slices.items():
+            if s.finished and not s.in_image and not s.stuffing: ready[md5] = s
+    elapsed = time.time() - started
+    return elapsed / count
+
+if __name__ == "__main__":
+    for count in (5000, 50000):
+        print "%6s slices: %.1f us per completion" % (count, time_completions(count) * 1000000)
+    print "%6s slices: %.1f us per completion, rescanning all slices" % \
+          (5000, time_rescans(5000) * 1000000)
@@ -20,6 +20,9 @@ from urlparse import urlparse
 import pyJigdo.logger
 import pyJigdo.pyasync
 from pyJigdo.jigdo import JigdoFile
+from pyJigdo.hashcache import HashCache
+from pyJigdo.scanindex import ScanIndex
+from pyJigdo.util import check_directory, set_hash_cache
 
 from pyJigdo.translate import _, N_
 
@@ -62,9 +65,23 @@ class PyJigdoBase:
         """ Start up the reactor and start performing operations to
             put the Jigdo together. """
         # Setup Reactor
+        (threads, thread_bounds) = self.download_threads()
         self.async = pyJigdo.pyasync.PyJigdoReactor( self.log,
-                     threads = self.settings.download_threads,
-                     timeout = self.settings.download_timeout )
+                     threads = threads,
+                     timeout = self.settings.download_timeout,
+                     hash_workers = self.settings.hash_workers,
+                     slice_order = self.settings.slice_order,
+                     idle_connections = self.settings.idle_connections,
+                     idle_timeout = self.settings.idle_timeout,
+                     min_speed = self.settings.min_speed,
+                     min_speed_time = self.settings.min_speed_time,
+                     hedge_after = self.settings.hedge_after,
+                     host_limit = self.settings.host_limit,
+                     rate_limit = self.settings.rate_limit,
+                     repo_limits = self.repo_limits(),
+                     thread_bounds = thread_bounds )
+        self.create_hash_cache()
+        self.create_scan_index()
         # Prepare Jigdo
         if self.prep_jigdo_files():
             # Seed Reactor
@@ -90,6 +107,49 @@ class PyJigdoBase:
         self.log = pyJigdo.logger.pyJigdoLogger( self.settings.log_file,
                                                  loglevel = loglevel )
 
+    def download_threads(self):
+        """ Return (threads, thread bounds) from the --threads option,
+            the bounds are only given for auto. """
+        if self.settings.download_threads == "auto":
+            low = max(1, self.settings.min_threads)
+            high = max(low, self.settings.max_threads)
+            return (low, (low, high))
+        return (int(self.settings.download_threads), None)
+
+    def repo_limits(self):
+        """ Return the --repo-limit options as {label: max downloads}. """
+        limits = {}
+        for limit in self.settings.repo_limits:
+            try:
+                (label, count) = limit.rsplit(":", 1)
+                limits[label] = int(count)
+            except ValueError:
+                self.log.warning(_("Ignoring --repo-limit %s, it should be label:number." % limit))
+        return limits
+
+    def create_hash_cache(self):
+        """ Setup the persistent hash cache, unless disabled. """
+        if self.settings.no_hash_cache: return
+        check_directory(self.log, self.settings.download_storage)
+        cache_location = os.path.join(self.settings.download_storage, "hashcache.db")
+        try:
+            set_hash_cache(HashCache( self.log,
+                                      cache_location,
+                                      max_entries = self.settings.hash_cache_size ))
+        except Exception, e:
+            self.log.warning(_("Could not open hash cache %s: %s" % (cache_location, e)))
+
+    def create_scan_index(self):
+        """ Setup the persistent index of scanned directories, unless disabled
+            or there is nothing to scan. """
+        if self.settings.no_scan_index or not self.settings.scan_dirs: return
+        check_directory(self.log, self.settings.download_storage)
+        index_location = os.path.join(self.settings.download_storage, "scanindex.db")
+        try:
+            self.async.scan_index = ScanIndex(self.log, index_location)
+        except Exception, e:
+            self.log.warning(_("Could not open scan index %s: %s" % (index_location, e)))
+
     def prep_jigdo_files(self):
         """ Prepare selected Jigdo downloads for injection into our reactor. """
         for jigdo in self.args_jigdo_files:
@@ -19,6 +19,12 @@ PYJIGDO_BASE_CONF_DIR = "/etc/pyjigdo"
 PYJIGDO_VERSION = "Git Development Hacking"
 PYJIGDO_USER_AGENT = "pyJigdo/" + PYJIGDO_VERSION
 
+# Download queue priorities, lower goes first.
+DOWNLOAD_PRIORITY_META = 0 # Jigdo files and templates.
+DOWNLOAD_PRIORITY_SLICE = 1
+# Orders slices can be downloaded in.
+SLICE_ORDERS = ("fifo", "largest", "offset")
+
 PYJIGDO_LOGO = """
                 .-. _          .-.      
                 : ::_;         : :      
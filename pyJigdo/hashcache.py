@@ -0,0 +1,136 @@
+#
+# Copyright 2007-2009 Fedora Unity Project (http://fedoraunity.org)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+A persistent cache of file hashes, so we don't have to re-read data we
+have already hashed in an earlier run. Entries are keyed by the device,
+inode, size and mtime of the file, so any change to a file misses.
+"""
+
+import os, time, threading
+
+try:
+    # Py2.5
+    import sqlite3
+except ImportError:
+    # Py2.4
+    from pysqlite2 import dbapi2 as sqlite3
+
+from pyJigdo.translate import _, N_
+
+# Commit to disk after this many new entries.
+COMMIT_INTERVAL = 100
+
+def stat_key(st):
+    """ Return the cache key for the given os.stat() result. """
+    return (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime * 1000000000))
+
+class HashCache:
+    """ An sqlite backed cache of jigdo md5 sums, holding at most
+        max_entries entries. The least recently used are evicted first.
+        This is used from more than one thread, so all access is locked. """
+    def __init__(self, log, location, max_entries=100000):
+        self.log = log
+        self.location = location
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(location, check_same_thread=False)
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                        " dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,"
+                        " md5 TEXT, used INTEGER,"
+                        " PRIMARY KEY (dev, ino, size, mtime_ns))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)")
+        self.entries = self.db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+    def lookup(self, file):
+        """ Return the cached md5 sum of file, or None. """
+        try:
+            key = stat_key(os.stat(file))
+        except OSError:
+            return None
+        self.lock.acquire()
+        try:
+            row = self.db.execute("SELECT md5 FROM hashes WHERE"
+                                  " dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                                  key).fetchone()
+            if not row:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE hashes SET used = ? WHERE"
+                            " dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                            (int(time.time()),) + key)
+            return str(row[0])
+        finally:
+            self.lock.release()
+
+    def store(self, file, md5, st=None):
+        """ Remember md5 as the sum of file. st is the os.stat() of file taken
+            before it was hashed, if the file has changed since, nothing is
+            stored. """
+        try:
+            current = os.stat(file)
+        except OSError:
+            return
+        key = stat_key(current)
+        if st and stat_key(st) != key: return
+        self.lock.acquire()
+        try:
+            now = int(time.time())
+            # Only count rows that are new, re-storing a key replaces it.
+            updated = self.db.execute("UPDATE hashes SET md5 = ?, used = ? WHERE"
+                                      " dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                                      (md5, now) + key).rowcount
+            if not updated:
+                self.db.execute("INSERT INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                                key + (md5, now))
+                self.entries += 1
+            self.uncommitted += 1
+            if self.entries > self.max_entries: self.evict()
+            if self.uncommitted >= COMMIT_INTERVAL: self.commit()
+        finally:
+            self.lock.release()
+
+    def evict(self):
+        """ Drop the least recently used tenth of the cache. """
+        count = max(1, self.max_entries / 10)
+        self.db.execute("DELETE FROM hashes WHERE rowid IN"
+                        " (SELECT rowid FROM hashes ORDER BY used LIMIT ?)", (count,))
+        self.entries = self.db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+        self.log.debug(_("Hash cache evicted %s entries." % count))
+
+    def commit(self):
+        """ Write pending entries to disk. """
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        """ Write everything out and close the cache. """
+        self.lock.acquire()
+        try:
+            self.commit()
+            self.db.close()
+        finally:
+            self.lock.release()
+
+    def __str__(self):
+        return _("Hash cache: %s hits, %s misses, %s entries" % \
+                 (self.hits, self.misses, self.entries))
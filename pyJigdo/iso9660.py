@@ -0,0 +1,212 @@
+#
+# Copyright 2007-2009 Fedora Unity Project (http://fedoraunity.org)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+A read-only ISO9660 directory reader, with Rock Ridge and Joliet names.
+This lists where each file's data is in an ISO image, so old images can
+be scanned (and their data reused) without mounting them.
+"""
+
+import struct
+
+from pyJigdo.translate import _, N_
+
+SECTOR_SIZE = 2048
+FIRST_DESCRIPTOR = 16
+DESCRIPTOR_PRIMARY = 1
+DESCRIPTOR_SUPPLEMENTARY = 2
+DESCRIPTOR_TERMINATOR = 255
+JOLIET_ESCAPES = ("%/@", "%/C", "%/E")
+ROOT_RECORD_OFFSET = 156
+
+FLAG_DIRECTORY = 0x02
+FLAG_MULTI_EXTENT = 0x80
+
+class IsoError(Exception):
+    """ The image could not be understood. """
+    pass
+
+class IsoExtent:
+    """ A file in an ISO image: its path and where its data is. """
+    def __init__(self, path, offset, size):
+        self.path = path
+        self.offset = offset
+        self.size = size
+
+    def __str__(self):
+        return "%s %s %s" % (self.path, self.offset, self.size)
+
+class IsoReader:
+    """ Read the directory tree of an ISO9660 image. """
+    def __init__(self, log, location):
+        self.log = log
+        self.location = location
+        self.f = None
+        self.rock_ridge = False
+        self.susp_skip = 0
+
+    def read_sectors(self, sector, length):
+        """ Return length bytes starting at sector. """
+        self.f.seek(sector * SECTOR_SIZE)
+        data = self.f.read(length)
+        if len(data) != length:
+            raise IsoError(_("%s is truncated." % self.location))
+        return data
+
+    def extents(self):
+        """ Return a list of IsoExtent()s for all files in the image.
+            Rock Ridge names are preferred, then Joliet, then plain ISO9660. """
+        self.f = open(self.location, "rb")
+        try:
+            primary = None
+            joliet = None
+            sector = FIRST_DESCRIPTOR
+            while True:
+                descriptor = self.read_sectors(sector, SECTOR_SIZE)
+                if descriptor[1:6] != "CD001":
+                    raise IsoError(_("%s is not an ISO9660 image." % self.location))
+                descriptor_type = ord(descriptor[0])
+                if descriptor_type == DESCRIPTOR_TERMINATOR: break
+                if descriptor_type == DESCRIPTOR_PRIMARY and not primary:
+                    primary = descriptor
+                elif descriptor_type == DESCRIPTOR_SUPPLEMENTARY and \
+                     descriptor[88:91] in JOLIET_ESCAPES:
+                    joliet = descriptor
+                sector += 1
+            if not primary:
+                raise IsoError(_("%s has no primary volume descriptor." % self.location))
+            root = self.parse_record(primary, ROOT_RECORD_OFFSET)
+            self.check_rock_ridge(root)
+            if self.rock_ridge or not joliet:
+                self.log.debug(_("Reading %s (Rock Ridge: %s)" % (self.location, self.rock_ridge)))
+                return self.walk(root, "", joliet=False)
+            self.log.debug(_("Reading %s using Joliet names" % self.location))
+            return self.walk(self.parse_record(joliet, ROOT_RECORD_OFFSET), "", joliet=True)
+        finally:
+            self.f.close()
+            self.f = None
+
+    def parse_record(self, data, pos):
+        """ Parse the directory record at data[pos:].
+            Return (extent sector, size, flags, name, system use). """
+        length = ord(data[pos])
+        sector = struct.unpack("<I", data[pos+2:pos+6])[0]
+        size = struct.unpack("<I", data[pos+10:pos+14])[0]
+        flags = ord(data[pos+25])
+        name_length = ord(data[pos+32])
+        name = data[pos+33:pos+33+name_length]
+        system_use_start = 33 + name_length + (1 - name_length % 2)
+        system_use = data[pos+system_use_start:pos+length]
+        return (sector, size, flags, name, system_use)
+
+    def check_rock_ridge(self, root):
+        """ Look for the SUSP 'SP' entry in the root's '.' record. """
+        (sector, size, flags, name, system_use) = root
+        data = self.read_sectors(sector, SECTOR_SIZE)
+        dot = self.parse_record(data, 0)
+        dot_use = dot[4]
+        if dot_use[:2] == "SP" and dot_use[4:6] == "\xbe\xef":
+            # SUSP is in use, so file records may carry Rock Ridge names.
+            self.susp_skip = ord(dot_use[6])
+            self.rock_ridge = True
+
+    def susp_entries(self, system_use):
+        """ Yield (signature, entry data) for the SUSP entries in system_use,
+            following continuation areas. """
+        areas = [system_use]
+        while areas:
+            data = areas.pop(0)
+            pos = 0
+            while pos + 4 <= len(data):
+                signature = data[pos:pos+2]
+                length = ord(data[pos+2])
+                if length < 4: break
+                entry = data[pos+4:pos+length]
+                if signature == "CE":
+                    ce_sector = struct.unpack("<I", entry[0:4])[0]
+                    ce_offset = struct.unpack("<I", entry[8:12])[0]
+                    ce_length = struct.unpack("<I", entry[16:20])[0]
+                    self.f.seek(ce_sector * SECTOR_SIZE + ce_offset)
+                    areas.append(self.f.read(ce_length))
+                elif signature == "ST":
+                    break
+                else:
+                    yield (signature, entry)
+                pos += length
+
+    def rock_ridge_info(self, system_use):
+        """ Return (name, child link sector, relocated) from Rock Ridge
+            entries. name is None if there is no NM entry. """
+        name = None
+        child_link = None
+        relocated = False
+        for (signature, entry) in self.susp_entries(system_use[self.susp_skip:]):
+            if signature == "NM":
+                nm_flags = ord(entry[0])
+                # Skip the '.' and '..' entries.
+                if nm_flags & 0x06: continue
+                name = (name or "") + entry[1:]
+            elif signature == "CL":
+                child_link = struct.unpack("<I", entry[0:4])[0]
+            elif signature == "RE":
+                relocated = True
+        return (name, child_link, relocated)
+
+    def clean_name(self, name, joliet):
+        """ Turn a plain ISO9660 or Joliet name into a file name. """
+        if joliet: name = name.decode("utf-16-be").encode("utf-8")
+        if ";" in name: name = name[:name.rindex(";")]
+        if name.endswith(".") and not joliet: name = name[:-1]
+        if not joliet: name = name.lower()
+        return name
+
+    def walk(self, directory, path, joliet=False, seen=None):
+        """ Return IsoExtent()s for everything under directory. """
+        if seen is None: seen = {}
+        (sector, size, flags, name, system_use) = directory
+        if seen.has_key(sector): return []
+        seen[sector] = True
+        found = []
+        data = self.read_sectors(sector, size)
+        pos = 0
+        while pos < len(data):
+            length = ord(data[pos])
+            if length == 0:
+                # Records never cross a sector, move on to the next one.
+                pos = (pos / SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+            record = self.parse_record(data, pos)
+            pos += length
+            (r_sector, r_size, r_flags, r_name, r_system_use) = record
+            if r_name in ("\x00", "\x01"): continue
+            child_link = None
+            file_name = None
+            if self.rock_ridge and not joliet:
+                (file_name, child_link, relocated) = self.rock_ridge_info(r_system_use)
+                if relocated: continue
+            if not file_name: file_name = self.clean_name(r_name, joliet)
+            file_path = "/".join([p for p in (path, file_name) if p])
+            if child_link is not None:
+                child_data = self.read_sectors(child_link, SECTOR_SIZE)
+                found.extend(self.walk(self.parse_record(child_data, 0), file_path, joliet, seen))
+            elif r_flags & FLAG_DIRECTORY:
+                found.extend(self.walk(record, file_path, joliet, seen))
+            elif r_flags & FLAG_MULTI_EXTENT:
+                self.log.debug(_("Skipping multi-extent file %s in %s" % (file_path, self.location)))
+            else:
+                found.append(IsoExtent(file_path, r_sector * SECTOR_SIZE, r_size))
+        return found
@@ -18,15 +18,41 @@
 Implementation of Jigdo concepts, calling jigdo-file when needed.
 """
 
-import os, urlparse, sys, gzip
+import os, urlparse, sys, gzip, marshal
+from array import array
 from random import shuffle
-from ConfigParser import RawConfigParser
+from ConfigParser import RawConfigParser, MissingSectionHeaderError, ParsingError
+from twisted.internet import defer
 
 from pyJigdo.userinterface import SelectImages
-from pyJigdo.util import url_to_file_name, check_complete, run_command, check_directory
+from pyJigdo.constants import DOWNLOAD_PRIORITY_META, DOWNLOAD_PRIORITY_SLICE
+from pyJigdo.template import JigdoTemplateReader, JigdoImageAssembler, \
+                             TemplateMatchedFile, TemplateImageInfo, TemplateError
+from pyJigdo.iso9660 import IsoReader
+from pyJigdo.util import url_to_file_name, check_complete, check_download, \
+                         check_directory, copy_extent, remove_file, md5_hashlib, M
 
 from pyJigdo.translate import _, N_
 
+# Bytes of (decompressed) .jigdo data to read at a time when parsing.
+PARSE_BLOCK_SIZE = 1024*1024
+# [Parts] lines starting with one of these can't take the fast path.
+PARTS_SLOW_START = "[#;rR \t\r"
+# Bump when the layout of the parsed definition cache changes.
+PARSE_CACHE_VERSION = 3
+
+def definition_lines(fp):
+    """ Yield the lines of fp, without line endings, reading it in
+        PARSE_BLOCK_SIZE blocks rather than a line at a time. """
+    rest = ""
+    while True:
+        block = fp.read(PARSE_BLOCK_SIZE)
+        if not block: break
+        lines = (rest + block).split("\n")
+        rest = lines.pop()
+        for line in lines: yield line
+    if rest: yield rest
+
 class JigdoFile:
     """ A Jigdo file that has been requested to be downloaded. """
     def __init__(self, log, async, settings, base, jigdo_location, jigdo_storage_location):
@@ -50,6 +76,10 @@ class JigdoFile:
         """ Return the target location for this jigdo file. """
         return self.fs_location
 
+    def download_priority(self, slice_order):
+        """ Return where this goes in the download queue, lowest first. """
+        return (DOWNLOAD_PRIORITY_META,)
+
     def download_callback_success(self, ign):
         """ Callback entry point for when self.get() is successful. """
         self.download_tries += 1
@@ -78,7 +108,8 @@ class JigdoFile:
     def queue_download(self):
         """ Queue the self.get() in the async. 
             We always need to re-fetch the jigdo file as we don't
-            have a verified sum for the data. """
+            have a verified sum for the data, but the request is
+            conditional, so an unchanged file is not downloaded again. """
         self.async.request_download(self)
 
     def get(self):
@@ -90,7 +121,7 @@ class JigdoFile:
             attempt = self.download_tries + 1
         self.log.status(_("Adding a task to download: %s (attempt: %s)" % \
                        (self.id, attempt)))
-        return self.async.download_object(self)
+        return self.async.download_object(self, conditional=True)
 
     def get_templates(self):
         """ Download the Jigdo file's defined templates that
@@ -134,6 +165,9 @@ class JigdoFile:
 class JigdoDefinition:
     """ A Jigdo Definition File.
         just_print is used to suppress the creation of objects. """
+    # Plain [Parts] lines skip the RawConfigParser regexes, see parse().
+    parts_fast_path = True
+
     def __init__(self, async, log, settings, file_name, just_print = False):
         self.async = async
         self.log = log
@@ -144,7 +178,16 @@ class JigdoDefinition:
         self.parts = None
         self.servers = None
         self.mirrors = None
-        self.parse()
+        self.section_options = [] # [(section name, [(option, value),]),] as parsed.
+        self._sections = [] # The section objects, in the order they are defined.
+        cache_location = self.cache_location()
+        if cache_location:
+            cache_key = self.cache_key()
+            if not self.load_cache(cache_location, cache_key):
+                self.parse()
+                self.store_cache(cache_location, cache_key)
+        else:
+            self.parse()
         if not just_print: self.create_objects()
 
     def list_images(self):
@@ -165,14 +208,116 @@ class JigdoDefinition:
         self.log.status(_("==== Parts defined in Jigdo ===="))
         self.log.status(self.parts)
 
+    def cache_location(self):
+        """ Return where the parsed form of this definition is cached,
+            or None if the cache is disabled. """
+        if self.settings.no_jigdo_cache: return None
+        return os.path.join( self.settings.download_storage,
+                             "%s.parsed" % os.path.basename(self.file_name) )
+
+    def cache_key(self):
+        """ Return the (size, md5) of the definition file, the cache is
+            only used for the exact file it was made from. """
+        md5 = md5_hashlib.md5()
+        f = open(self.file_name, "rb")
+        try:
+            while True:
+                data = f.read(PARSE_BLOCK_SIZE)
+                if not data: break
+                md5.update(data)
+        finally:
+            f.close()
+        return (os.path.getsize(self.file_name), md5.hexdigest())
+
+    def load_cache(self, location, key):
+        """ Set up the sections from the cached parse at location.
+            Return False if there is none, or it is not for key. """
+        try:
+            f = open(location, "rb")
+            try:
+                (version, cached_key, section_options, parts) = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return False
+        if version != PARSE_CACHE_VERSION or cached_key != tuple(key): return False
+        for (sectname, options) in section_options:
+            section = self.new_section(sectname)
+            for (optname, optval) in options: section.add_option(optname, optval)
+        if self.parts: self.parts.load_cache_data(parts)
+        self.section_options = section_options
+        self.log.debug(_("Using the cached parse of %s from %s" % (self.file_name, location)))
+        return True
+
+    def store_cache(self, location, key):
+        """ Write what parse() found to the cache at location, for key. """
+        parts = None
+        if self.parts: parts = self.parts.cache_data()
+        try:
+            check_directory(self.log, os.path.dirname(location))
+            f = open("%s.tmp" % location, "wb")
+            try:
+                marshal.dump((PARSE_CACHE_VERSION, key, self.section_options, parts), f)
+            finally:
+                f.close()
+            os.rename("%s.tmp" % location, location)
+        except (IOError, OSError), e:
+            self.log.warning(_("Could not cache the parse of %s: %s" % (self.file_name, e)))
+
+    def new_section(self, sectname):
+        """ Return a new object for the section sectname, keeping track
+            of the special sections. """
+        # This is where we have found an [Image] section
+        # and now need to create our object to stuff data into.
+        if sectname == "Image":
+            self.image_unique_id += 1
+            section = JigdoImage( self.log,
+                                  self.async,
+                                  self.settings,
+                                  self,
+                                  unique_id = self.image_unique_id )
+            self.images[self.image_unique_id] = section
+        # Here we have found the [Parts] section and need to create
+        # the object to stuff data into.
+        elif sectname == "Parts":
+            section = JigdoPartsDefinition(sectname, self.log)
+            self.parts = section
+        # Here we have found the [Servers] section and need to create
+        # the definition object to be able to add the options.
+        elif sectname == "Servers":
+            section = JigdoServersDefinition(sectname, self.log, self.async)
+            self.servers = section
+        # Here we have found our (pyjigdo's) new [Mirrorlists] section.
+        # This allows users to define a source to 'ping' for the most
+        # recent url lists for a give part. The part file name is appended to the
+        # request and we expect a list of valid (or thought to be valid) URLs
+        # for which we can iterate to find a server with the given file.
+        elif sectname == "Mirrorlists":
+            section = JigdoMirrorlistsDefinition( sectname,
+                                                  self.log,
+                                                  self.async,
+                                                  self.settings )
+            self.mirrors = section
+        else:
+            section = JigdoDefinitionSection(sectname)
+        self._sections.append(section)
+        return section
 
     def parse(self):
-        """ This parses the JigdoDefinition.file_name """
-        cursect = None                            # None, or a dictionary
+        """ This parses the JigdoDefinition.file_name.
+            Lines are read from the (decompressed) file in large blocks.
+            [Parts] can hold tens of thousands of "md5=label:path" lines,
+            those take a fast path, everything else is parsed the way
+            RawConfigParser would. """
+        cursect = None                            # None, or a section object
         optname = None
+        optvals = []                              # Lines of optname's value so far.
+        options = []                              # (option, value)s of cursect, for the cache.
+        keep_case = False                         # Option names are not lowercased.
+        parts = None                              # cursect, while in [Parts]
+        partname = None                           # The last part taking the fast path.
         lineno = 0
         e = None                                  # None, or an exception
-        self._sections = []
 
         try:
             # If you try to read a non-gzip file with this class, it will throw an IOError
@@ -182,69 +327,60 @@ class JigdoDefinition:
             self.log.debug(_("Jigdo file is Gzipped."))
         except IOError:
             fp = open(self.file_name,"r")
-            
-        while True:
-            line = fp.readline()
-            if not line:
-                break
-            # comment or blank line?
-            if line.strip() in ('','\n') or line[0] in ('#', ';'):
-                continue
-            if line.split(None, 1)[0].lower() == 'rem' and line[0] in "rR":
-                continue
 
-            # no leading whitespace
-            # continuation line?
-            if line[0].isspace() and cursect is not None and optname:
-                value = line.strip()
-                if value:
-                    cursect[optname] = "%s\n%s" % (cursect[optname], value)
-            # a section header or option header?
-            else:
+        try:
+            for line in definition_lines(fp):
+                lineno += 1
+                if parts is not None and line and line[0] not in PARTS_SLOW_START:
+                    pos = line.find('=')
+                    if pos > 0 and line.find(':', 0, pos) == -1:
+                        optval = line[pos+1:].strip()
+                        if optval == '""': optval = ''
+                        if ';' not in optval:
+                            if optname:
+                                options.append((optname, "\n".join(optvals)))
+                                cursect.add_option(*options[-1])
+                                optname = None
+                            partname = line[:pos].rstrip()
+                            parts.add_option(partname, optval)
+                            continue
+                # comment or blank line?
+                if not line.strip() or line[0] in ('#', ';'):
+                    continue
+                if line.split(None, 1)[0].lower() == 'rem' and line[0] in "rR":
+                    continue
+
+                # no leading whitespace
+                # continuation line?
+                if line[0].isspace() and cursect is not None and optname:
+                    value = line.strip()
+                    if value: optvals.append(value)
+                    continue
+                if line[0].isspace() and parts is not None and partname:
+                    value = line.strip()
+                    if value: parts.add_option(partname, "%s\n%s" % (parts[partname], value))
+                    continue
+                partname = None
+                # The value of the last option is complete.
+                if optname:
+                    options.append((optname, "\n".join(optvals)))
+                    cursect.add_option(*options[-1])
+                    optname = None
+                # a section header or option header?
                 # is it a section header?
                 mo = RawConfigParser.SECTCRE.match(line)
                 if mo:
                     sectname = mo.group('header')
-                    # This is where we have found an [Image] section
-                    # and now need to create our object to stuff data into.
-                    if sectname == "Image":
-                        self.image_unique_id += 1
-                        section = JigdoImage( self.log,
-                                              self.async,
-                                              self.settings,
-                                              self,
-                                              unique_id = self.image_unique_id )
-                        self.images[self.image_unique_id] = section
-                    # Here we have found the [Parts] section and need to create
-                    # the object to stuff data into.
-                    elif sectname == "Parts":
-                        section = JigdoPartsDefinition(sectname, self.log)
-                        self.parts = section
-                    # Here we have found the [Servers] section and need to create
-                    # the definition object to be able to add the options.
-                    elif sectname == "Servers":
-                        section = JigdoServersDefinition(sectname, self.log)
-                        self.servers = section
-                    # Here we have found our (pyjigdo's) new [Mirrorlists] section.
-                    # This allows users to define a source to 'ping' for the most
-                    # recent url lists for a give part. The part file name is appended to the
-                    # request and we expect a list of valid (or thought to be valid) URLs
-                    # for which we can iterate to find a server with the given file.
-                    elif sectname == "Mirrorlists":
-                        section = JigdoMirrorlistsDefinition( sectname,
-                                                              self.log,
-                                                              self.async,
-                                                              self.settings )
-                        self.mirrors = section
-                    else:
-                        section = JigdoDefinitionSection(sectname)
+                    parts = None
+                    keep_case = sectname in ("Parts", "Servers", "Mirrorlists")
+                    section = self.new_section(sectname)
+                    if sectname == "Parts" and self.parts_fast_path: parts = section
                     cursect = section
-                    self._sections.append(section)
-                    # So sections can't start with a continuation line
-                    optname = None
+                    options = []
+                    self.section_options.append((sectname, options))
                 # no section header in the file?
                 elif cursect is None:
-                    raise MissingSectionHeaderError(fpname, lineno, line)
+                    raise MissingSectionHeaderError(self.file_name, lineno, line)
                 # an option line?
                 else:
                     mo = RawConfigParser.OPTCRE.match(line)
@@ -260,19 +396,24 @@ class JigdoDefinition:
                         # allow empty values
                         if optval == '""':
                             optval = ''
-                        if not (isinstance(cursect, JigdoPartsDefinition) or \
-                                isinstance(cursect, JigdoServersDefinition) or \
-                                isinstance(cursect, JigdoMirrorlistsDefinition)):
+                        if keep_case:
+                            optname = optname.rstrip()
+                        else:
                             optname = optname.rstrip().lower().replace("-","_")
-                        cursect.add_option(optname,optval)
+                        optvals = [optval]
                     else:
                         # a non-fatal parsing error occurred.  set up the
                         # exception but keep going. the exception will be
                         # raised at the end of the file and will contain a
                         # list of all bogus lines
                         if not e:
-                            e = ParsingError(fpname)
+                            e = ParsingError(self.file_name)
                         e.append(lineno, repr(line))
+            if optname:
+                options.append((optname, "\n".join(optvals)))
+                cursect.add_option(*options[-1])
+        finally:
+            fp.close()
         # if any parsing errors occurred, raise an exception
         if e:
             raise e
@@ -297,9 +438,10 @@ class JigdoDefinitionSection:
 
 class JigdoServersDefinition:
     """ The [servers] section of a jigdo configuration file. """
-    def __init__(self, name, log):
+    def __init__(self, name, log, async):
         self._section_name = name
         self.log = log
+        self.async = async
         self.i = {}
         self.objects = {}
 
@@ -322,7 +464,8 @@ class JigdoServersDefinition:
         """ Create the JigdoRepoDefinition objects based on what information we have
             in self.i (index). """
         for (server_id, server_url_list) in self.i.iteritems():
-            self.objects[server_id] = JigdoRepoDefinition(server_id, server_url_list, self.log)
+            self.objects[server_id] = JigdoRepoDefinition( server_id, server_url_list, self.log,
+                                                           mirror_stats = self.async.mirror_stats )
 
 class JigdoMirrorlistsDefinition:
     """ The [mirrorlists] section of a jigdo configuration file.
@@ -372,7 +515,9 @@ class JigdoMirrorlistsDefinition:
         return self.async.fetch_data( self.i[repo_id][0],
                                       self.fetch_callback_success,
                                       self.fetch_callback_failure,
-                                      repo_id )
+                                      repo_id,
+                                      location = os.path.join( self.settings.download_storage,
+                                                               "mirrorlists", repo_id ) )
 
     def __str__(self):
         """ Return the mirror lists we know about.
@@ -411,31 +556,91 @@ class JigdoMirrorlistsDefinition:
                 self.log.warning(_("Server ID '%s' does not have a matching matching mirrorlist.") % repo_id)
 
 class JigdoPartsDefinition:
-    """ The [parts] section of a jigdo configuration file. """
+    """ The [parts] section of a jigdo configuration file. The
+        "label:path" values are kept split in parallel arrays, so each
+        label is kept once and the path strings can be shared with the
+        slices. """
     def __init__(self, name, log):
         self._section_name = name
         self.log = log
-        self.i = {}
+        self.labels = [] # Every label once, None for values without one.
+        self.label_rows = {} # {label: index in self.labels}
+        self.rows = {} # {md5: index in self.part_labels and self.paths}
+        self.part_labels = array('H') # Index in self.labels of each part.
+        self.paths = []
 
     def __getitem__(self, item):
         # Return the part data
-        return self.i[item]
+        (label, path) = self.part(item)
+        if label is None: return path
+        return "%s:%s" % (label, path)
+
+    def __len__(self):
+        return len(self.rows)
 
     def __str__(self):
-        return "\tThere are %s files defined." % len(self.i)
+        return "\tThere are %s files defined." % len(self)
 
     def add_option(self, name, val = None):
-        self.i[name] = val
+        pos = val.find(':')
+        if pos == -1:
+            label = None
+            path = val
+        else:
+            label = val[:pos]
+            path = val[pos+1:]
+        try:
+            label_row = self.label_rows[label]
+        except KeyError:
+            label_row = self.add_label(label)
+        paths = self.paths
+        row = self.rows.setdefault(name, len(paths))
+        if row == len(paths):
+            self.part_labels.append(label_row)
+            paths.append(path)
+        else:
+            self.part_labels[row] = label_row
+            paths[row] = path
+
+    def add_label(self, label):
+        """ Return the index of the new label in self.labels. """
+        if label is not None: label = intern(label)
+        self.label_rows[label] = len(self.labels)
+        self.labels.append(label)
+        return self.label_rows[label]
+
+    def part(self, md5):
+        """ Return the (label, path) of the part with md5. """
+        row = self.rows[md5]
+        return (self.labels[self.part_labels[row]], self.paths[row])
+
+    def iteritems(self):
+        """ Yield (md5, (label, path)) for every part. """
+        for (md5, row) in self.rows.iteritems():
+            yield (md5, (self.labels[self.part_labels[row]], self.paths[row]))
+
+    def cache_data(self):
+        """ Return the parts in a form marshal can store. """
+        return (self.labels, self.rows, self.part_labels.tostring(), self.paths)
+
+    def load_cache_data(self, data):
+        """ Set up the parts from what cache_data() returned. """
+        (self.labels, self.rows, part_labels, self.paths) = data
+        self.label_rows = dict([(label, row) for (row, label) in enumerate(self.labels)])
+        self.part_labels = array('H')
+        self.part_labels.fromstring(part_labels)
 
 class JigdoRepoDefinition:
     """ A repo definition that can return an url for a given label.
         Baseurls and mirrorlist need to be lists. """
-    def __init__(self, label, baseurls, log, mirrorlist=[]):
+    def __init__(self, label, baseurls, log, mirrorlist=[], mirror_stats=None):
         self.label = label
         self.baseurls = baseurls
         self.log = log
         self.mirrorlist = mirrorlist
-        self.history = {} # { file: [base_url,] }
+        self.mirror_stats = mirror_stats # MirrorScores()
+        self.sources = {} # { base_url: bit in the history masks }
+        self.history = {} # { file: mask of the base_urls tried }
 
     def __str__(self):
         """ Return data about this JigdoRepo. """
@@ -444,34 +649,29 @@ class JigdoRepoDefinition:
 
     def get_url(self, file, use_only_servers = False):
         """ Get a resolved url from this repo, given a file name.
-            If use_only_servers is True, only baseurls will be tried. """
+            If use_only_servers is True, only baseurls will be tried.
+            Of the sources not tried for this file yet, the one the
+            mirror statistics say is best is used. """
         base_url = None
-        # Make sure we have a history for this file.
-        try:
-            c = self.history[file]
-        except KeyError:
-            self.history[file] = []
-        
+        tried = self.history.get(file, 0)
+
         if use_only_servers:
             # Only look for a source defined by a [servers] section
             # Always try all [servers]
-            for source in self.baseurls:
-                if source not in self.history[file]:
-                    base_url = source
-                    self.history[file].append(source)
-                    break
+            source_list = self.baseurls
         else:
-            # Find a mirror we have not tried yet.
             source_list = self.mirrorlist + self.baseurls
-            if not (len(self.history[file]) >= len(source_list)):
-                for source in source_list:
-                    if source not in self.history[file]:
-                        base_url = source
-                        self.history[file].append(source)
-                        break
+        # Find a source we have not tried yet.
+        untried = [source for source in source_list if not tried & self.source_bit(source)]
+        if untried:
+            if self.mirror_stats:
+                base_url = self.mirror_stats.choose(untried)
+            else:
+                base_url = untried[0]
+            self.history[file] = tried | self.source_bit(base_url)
 
         self.log.debug(_("Sourced base URL %s for file %s" % (base_url, file)))
-        self.log.debug(_("File %s history: %s" % (file, " ".join(self.history[file]))))
+        self.log.debug(_("File %s history: %s" % (file, " ".join(self.tried_sources(file)))))
 
         if not base_url: return None
         urldata = urlparse.urlsplit(base_url)
@@ -485,6 +685,31 @@ class JigdoRepoDefinition:
             pass
         return url
 
+    def source_bit(self, base_url):
+        """ Return the bit standing for base_url in the history masks.
+            Keeping one small int per file, rather than a list, matters
+            with tens of thousands of parts. """
+        try:
+            return self.sources[base_url]
+        except KeyError:
+            self.sources[base_url] = 1 << len(self.sources)
+            return self.sources[base_url]
+
+    def tried_sources(self, file):
+        """ Return the base_urls tried for file. """
+        tried = self.history.get(file, 0)
+        return [base_url for (base_url, bit) in self.sources.items() if tried & bit]
+
+    def get_urls(self, file, count, use_only_servers = False):
+        """ Get up to count different resolved urls from this repo,
+            given a file name. See get_url(). """
+        urls = []
+        while len(urls) < count:
+            url = self.get_url(file, use_only_servers)
+            if not url: break
+            urls.append(url)
+        return urls
+
 class JigdoImage:
     """ An Image in the Jigdo Definition File, defining JigdoTemplate and JigdoImageSlices. """
     def __init__(self, log, async, settings, jigdo_definition, unique_id = 0):
@@ -497,6 +722,10 @@ class JigdoImage:
         self.finished = False
         self.unique_id = unique_id
         self.slices = {}
+        # Kept up to date as slices change state, see slice_state_changed().
+        self.missing = {} # {md5: JigdoImageSlice()} not finished.
+        self.ready = {} # {md5: JigdoImageSlice()} finished, not in the image or being stuffed.
+        self.in_image = 0 # Number of slices put into the image this session.
         self.download_tries = 0
         self.scan_targets = [] # [ JigdoScanTarget(), ]
         # These are filled in when parsing the .jigdo definition
@@ -508,6 +737,7 @@ class JigdoImage:
         self.target_location = self.settings.download_target
         self.location = ''
         self.tmp_location = ''
+        self.assembler = None # JigdoImageAssembler()
 
     def __str__(self):
         """ Return formatted information about the given image.
@@ -523,21 +753,31 @@ class JigdoImage:
         """ Return the target location for this Jigdo template. """
         return self.fs_location
 
-    def verify(self):
-        """ Verify the template we have fetched is the correct template. """
+    def download_priority(self, slice_order):
+        """ Return where this goes in the download queue, lowest first. """
+        return (DOWNLOAD_PRIORITY_META,)
+
+    def verify(self, file_hash=None):
+        """ Verify the template we have fetched is the correct template.
+            file_hash is the sum taken while downloading, if we have one,
+            otherwise the data is read back from disk. """
+        if file_hash:
+            return check_download(self.log, self.target(), self.template_md5sum, file_hash)
         return check_complete(self.log, self.target(), self.template_md5sum)
 
-    def download_callback_success(self, ign):
+    def download_callback_success(self, file_hash):
         """ Callback entry point for when self.get() is successful. """
-        if self.verify():
+        if self.verify(file_hash):
             self.download_tries += 1
             self.log.status(_("Successfully downloaded jigdo template %s" % self.template))
             self.collect_slices()
-            self.scan_local_sources()
-            self.get_slices()
+            d = self.scan_local_sources()
+            d.addCallback(self.get_slices)
             self.log.debug(_("Ending download event for %s" % self.filename))
         else:
             self.log.status(_("Download for %s does not match required file." % self.filename))
+            # Don't resume from bad data.
+            remove_file(self.log, self.target())
             self.download_callback_failure(_("Checksum failed!"))
 
     def download_callback_failure(self, ign):
@@ -570,15 +810,23 @@ class JigdoImage:
             attempt = self.download_tries + 1
         self.log.status(_("Adding a task to download: %s (attempt: %s)" % \
                        (self.filename, attempt)))
-        return self.async.download_object(self)
+        return self.async.download_object(self, resume=True)
 
-    def get_slices(self):
+    def get_slices(self, ign=None):
         """ Download the template file's defined slices. """
         # These calls start their own event driven calls and
         # we now leave the template object callback from the
         # JigdoTemplate download request.
-        for jigdo_slice_hash,jigdo_slice in self.missing_slices().iteritems():
-            jigdo_slice.queue_download()
+        # Check what we already have all at once, in the hashing pool.
+        slices = self.missing_slices().values()
+        d = self.async.hasher.check_batch([(s.fs_location, s.slice_sum) for s in slices])
+        d.addCallback(self.get_slices_checked, slices)
+
+    def get_slices_checked(self, results, slices):
+        """ Callback entry point for when get_slices() has checked
+            which of the slices are already on disk. """
+        for (jigdo_slice, complete) in zip(slices, results):
+            jigdo_slice.queue_download(complete)
 
     def add_option(self,name, val = None):
         setattr(self,name,val)
@@ -589,50 +837,69 @@ class JigdoImage:
         self.tmp_location = "%s.tmp" % self.location
         template_target = self.fs_location
         iso_exists = False
-        if os.access(self.tmp_location, os.W_OK):
-            template_target = self.tmp_location
-            self.log.info(_("Temporary template found at %s" % template_target))
-            # FIXME: Need a test to see if this tmp image is usable.
-        template_data = self.async.jigdo_file.get_template_data(template_target)
         if os.access(self.location, os.R_OK): iso_exists = True
-        for line in template_data:
-            if line.startswith('need-file'):
-                slice_hash = line.split()[3]
-                (slice_server_id, slice_file_name) = self.jigdo_definition.parts[slice_hash].split(':')
-                if not iso_exists: self.slices[slice_hash] = JigdoImageSlice( self.log, self.async,
-                                                             self.settings,
-                                                             slice_hash,
-                                                             slice_file_name,
-                                                             self.jigdo_definition.servers.objects[slice_server_id],
-                                                             self.settings.download_storage,
-                                                             self )
-            elif line.startswith('image-info'):
-                self.filename_md5sum = line.split()[2]
-                if iso_exists:
-                    self.log.info(_("%s exists, checking..." % self.filename))
-                    if check_complete( self.log, self.location, self.filename_md5sum):
-                        self.log.status(_("%s is complete and located at %s" % \
-                                         ( self.filename, self.location) ))
-                        self.finished = True
-                        self.selected = False
-                        self.cleanup_template()
+        if self.settings.jigdo_file_assembly:
+            if os.access(self.tmp_location, os.W_OK):
+                template_target = self.tmp_location
+                self.log.info(_("Temporary template found at %s" % template_target))
+                # FIXME: Need a test to see if this tmp image is usable.
+        elif not iso_exists:
+            self.assembler = JigdoImageAssembler(self.log, self.fs_location, self.location)
+        try:
+            if self.assembler: self.assembler.open()
+            template_data = JigdoTemplateReader(self.log, template_target).entries()
+            for record in template_data:
+                if isinstance(record, TemplateMatchedFile):
+                    if record.written or iso_exists: continue
+                    if self.assembler and self.assembler.is_written(record.md5): continue
+                    if self.slices.has_key(record.md5): continue
+                    (slice_server_id, slice_file_name) = self.jigdo_definition.parts.part(record.md5)
+                    self.slices[record.md5] = JigdoImageSlice( record.md5,
+                                                               slice_file_name,
+                                                               self.jigdo_definition.servers.objects[slice_server_id],
+                                                               self,
+                                                               size = record.size,
+                                                               offset = record.offset )
+                    self.missing[record.md5] = self.slices[record.md5]
+                elif isinstance(record, TemplateImageInfo):
+                    self.filename_md5sum = record.md5
+                    if iso_exists:
+                        self.log.info(_("%s exists, checking..." % self.filename))
+                        if check_complete( self.log, self.location, self.filename_md5sum):
+                            self.log.status(_("%s is complete and located at %s" % \
+                                             ( self.filename, self.location) ))
+                            self.finished = True
+                            self.selected = False
+                            self.cleanup_template()
+        except (TemplateError, IOError, OSError), e:
+            self.log.critical(_("Could not read template %s: %s" % (template_target, e)))
 
     def finished_slices(self):
-        """ Returns a dictionary of slices that have been downloaded and marked as finished.
-            This also checks if the slice has been added to the target image during this session. """
-        finished_slices = {}
-        for (slice_hash, slice_object) in self.slices.iteritems():
-            if slice_object.finished and not slice_object.in_image:
-                finished_slices[slice_hash] = slice_object
-        return finished_slices
+        """ Returns a dictionary of slices that have been downloaded and marked as finished,
+            but have not been (and are not being) added to the target image during this
+            session. This is the live dictionary, don't change it. """
+        return self.ready
 
     def missing_slices(self):
-        """ Returns a dictionary of slices that are not marked as finished. """
-        missing_slices = {}
-        for (slice_hash, slice_object) in self.slices.iteritems():
-            if not slice_object.finished:
-                missing_slices[slice_hash] = slice_object
-        return missing_slices
+        """ Returns a dictionary of slices that are not marked as finished.
+            This is the live dictionary, don't change it. """
+        return self.missing
+
+    def slice_state_changed(self, jigdo_slice):
+        """ Move jigdo_slice to the right one of self.missing and self.ready
+            after its finished, stuffing or in_image flags changed. """
+        self.missing.pop(jigdo_slice.slice_sum, None)
+        self.ready.pop(jigdo_slice.slice_sum, None)
+        if not jigdo_slice.finished:
+            self.missing[jigdo_slice.slice_sum] = jigdo_slice
+        elif not (jigdo_slice.in_image or jigdo_slice.stuffing):
+            self.ready[jigdo_slice.slice_sum] = jigdo_slice
+
+    def progress(self):
+        """ Return how far along this image is. """
+        return _("%s: %s of %s slices in the image, %s waiting to be added, %s missing" % \
+                 ( self.filename, self.in_image, len(self.slices),
+                   len(self.ready), len(self.missing) ))
 
     def select(self):
         self.selected = True
@@ -650,72 +917,180 @@ class JigdoImage:
 
     def scan_local_sources(self):
         """ Check to see if we have been given any local sources
-            to scan for data before downloading. """
-        slices_by_filename = {}
-        for (k, s) in self.slices.items():
-            slices_by_filename[ s.filename ] = s
+            to scan for data before downloading.
+            Return a Deferred firing when all scans are done. """
         for scan_dir in self.settings.scan_dirs:
             d = JigdoScanTarget( self.log,
+                                 self.async,
                                  self.settings,
                                  scan_dir,
-                                 slices_by_filename )
+                                 self.slices )
             self.scan_targets.append( d )
         for scan_iso in self.settings.scan_isos:
             i = JigdoScanTarget( self.log,
+                                 self.async,
                                  self.settings,
                                  scan_iso,
-                                 slices_by_filename,
+                                 self.slices,
                                  is_iso = True )
             self.scan_targets.append( i )
-        for scan_target in self.scan_targets:
-            scan_target.run_scan()
+        return defer.DeferredList([scan_target.run_scan() for scan_target in self.scan_targets])
 
     def notify_slice_done(self):
         """ The main checkpoint callback to stuff data into the ISO. """
-        ready_slices = self.finished_slices()
-        if len(ready_slices.keys()) >= self.settings.download_stuff_bits:
+        if len(self.ready) >= self.settings.download_stuff_bits and \
+           not self.async.stuffer.full():
             self.stuff_data()
 
     def stuff_data(self):
-        """ Stuff data into the target ISO file. """
-        for slice in self.finished_slices().values():
-            if self.async.jigdo_file.stuff_bits_into_image( self,
-                                                            slice.fs_location,
-                                                            destroy = self.settings.download_stuff_then_remove ):
+        """ Queue finished slices to be stuffed into the target ISO file.
+            The work is done by the reactor's stuffing worker thread. """
+        ready_slices = self.finished_slices().values()
+        if not ready_slices: return
+        d = self.async.stuffer.submit(self.stuff_slices, ready_slices)
+        if not d:
+            self.log.debug(_("Stuffing queue is full, will stuff %s later." % self.filename))
+            return
+        for slice in ready_slices:
+            slice.stuffing = True
+            self.slice_state_changed(slice)
+        d.addCallback(self.stuff_callback_success, ready_slices)
+        d.addErrback(self.stuff_callback_failure, ready_slices)
+
+    def stuff_slices(self, slices):
+        """ Put given slices into the target ISO file and return a dictionary
+            of the md5 sums now in it. This runs in the stuffing worker thread,
+            so it must not touch anything the reactor thread is using. """
+        if not self.assembler:
+            return self.stuff_slices_jigdo_file(slices)
+        in_image = {}
+        for slice in slices:
+            try:
+                if self.assembler.add_file(slice.slice_sum, slice.fs_location,
+                                           slice.fs_offset or 0):
+                    in_image[slice.slice_sum] = True
+            except (TemplateError, IOError, OSError), e:
+                self.log.error(_("Failed to add %s to %s: %s" % (slice.filename, self.filename, e)))
+        # One fsync for the batch before it is journalled.
+        try:
+            self.assembler.sync()
+        except (IOError, OSError), e:
+            self.log.error(_("Failed to sync %s: %s" % (self.filename, e)))
+            return {}
+        return in_image
+
+    def stuff_slices_jigdo_file(self, slices):
+        """ Hand the whole batch to jigdo-file at once. jigdo-file only
+            takes whole files, so data found inside ISO images is copied
+            out to our storage for the run. """
+        files = []
+        extracted = []
+        for slice in slices:
+            if slice.fs_offset is None:
+                files.append(slice.fs_location)
+                continue
+            target = os.path.join(slice.target_location, slice.filename)
+            try:
+                copy_extent(self.log, slice.fs_location, slice.fs_offset, slice.size, target)
+            except (IOError, OSError), e:
+                self.log.error(_("Failed to copy %s out of %s: %s" % \
+                                 (slice.filename, slice.fs_location, e)))
+                continue
+            files.append(target)
+            extracted.append(target)
+        try:
+            return self.async.jigdo_file.stuff_bits_into_image(self, files)
+        finally:
+            for target in extracted:
+                try:
+                    os.remove(target)
+                except OSError:
+                    pass
+
+    def stuff_callback_success(self, in_image, slices):
+        """ Callback entry point for when stuff_slices() is done. """
+        destroy = self.settings.download_stuff_then_remove
+        for slice in slices:
+            slice.stuffing = False
+            if in_image.has_key(slice.slice_sum):
                 slice.in_image = True
+                self.in_image += 1
+                self.slice_state_changed(slice)
+                if destroy and slice.owns_data(): os.remove(slice.fs_location)
+            else:
+                slice.stuff_failed()
+
+    def stuff_callback_failure(self, failure, slices):
+        """ Callback entry point for when stuff_slices() fails. """
+        self.log.error(_("Stuffing data into %s failed: %s" % (self.filename, failure.getErrorMessage())))
+        self.stuff_callback_success({}, slices)
 
     def finish(self):
         """ Finish processing this template.
             Complain if we are not really done. """
-        self.log.debug(_("finish() has been called on %s, stuffing data." % self.filename))
-        self.stuff_data()
-        if self.missing_slices():
+        self.log.debug(_("finish() has been called on %s." % self.filename))
+        if self.missing_slices() or self.finished_slices():
             # FIXME: Do something other then complain.
             self.log.critical(_("finish() was called on template %s, but there is missing data!" % self.filename))
             return False
+        if self.assembler and not self.assembler.finish():
+            self.log.critical(_("ISO Image %s could not be put together!" % self.filename))
+            return False
         self.log.status(_("ISO Image %s is complete and located at %s" % ( self.filename,
                                                                            self.location )))
         return True
 
-class JigdoImageSlice:
-    """ A file needing to be downloaded for an image. """
-    def __init__(self, log, async, settings, md5_sum, filename, repo, target_location, template):
+class JigdoImageSlice(object):
+    """ A file needing to be downloaded for an image.
+        A jigdo can define tens of thousands of these, so they only keep
+        what is their own in slots, and reach the log, reactor and
+        settings through their template. """
+    __slots__ = ( "slice_sum", "filename", "repo", "template", "size", "offset",
+                  "found_location", "fs_offset", "current_source", "download_tries",
+                  "finished", "stuffing", "in_image" )
+
+    def __init__(self, md5_sum, filename, repo, template, size=0, offset=0):
         """ Initialize the ImageSlice """
-        self.log = log
-        self.async = async
-        self.settings = settings
         self.slice_sum = md5_sum
         self.filename = filename
         self.repo = repo
-        self.target_location = target_location
-        self.fs_location = os.path.join( self.target_location,
-                                         self.filename )
-        self.template = template
+        self.template = template # JigdoImage()
+        self.size = size
+        self.offset = offset
+        self.found_location = None # Set if our data was found outside our storage.
+        self.fs_offset = None # Where our data starts, if inside fs_location.
         self.current_source = None
         self.download_tries = 0
         self.finished = False
+        self.stuffing = False
         self.in_image = False
 
+    def get_log(self):
+        return self.template.log
+    log = property(get_log)
+
+    def get_async(self):
+        return self.template.async
+    async = property(get_async)
+
+    def get_settings(self):
+        return self.template.settings
+    settings = property(get_settings)
+
+    def get_target_location(self):
+        """ Return where we download our data to. """
+        return self.settings.download_storage
+    target_location = property(get_target_location)
+
+    def get_fs_location(self):
+        """ Return where our data is, our own storage unless it was found elsewhere. """
+        return self.found_location or os.path.join(self.target_location, self.filename)
+
+    def set_fs_location(self, location):
+        if location == os.path.join(self.target_location, self.filename): location = None
+        self.found_location = location
+    fs_location = property(get_fs_location, set_fs_location)
+
     def __str__(self):
         """ Return information about this slice.
             Note this is tab indented and return cleared. """
@@ -723,33 +1098,66 @@ class JigdoImageSlice:
                ( self.filename, self.repo.label, self.fs_location )
 
     def source(self):
-        """ Return the source location for this Jigdo slice. """
-        self.new_source()
+        """ Return the source location for this Jigdo slice.
+            The same source is returned until a download from it fails,
+            so the reactor can see where a download will go before
+            starting it. """
+        if not self.current_source: self.new_source()
         return self.current_source
 
     def target(self):
         """ Return the target location for this Jigdo slice. """
         return self.fs_location
 
-    def verify(self):
-        """ Verify the slice we have fetched is the correct data. """
+    def download_priority(self, slice_order):
+        """ Return where this goes in the download queue, lowest first.
+            slice_order is one of constants.SLICE_ORDERS. """
+        if slice_order == "largest":
+            return (DOWNLOAD_PRIORITY_SLICE, -self.size)
+        if slice_order == "offset":
+            return (DOWNLOAD_PRIORITY_SLICE, self.template.filename, self.offset)
+        return (DOWNLOAD_PRIORITY_SLICE,)
+
+    def owns_data(self):
+        """ Return True if the data is ours (downloaded to our storage)
+            and not a file found while scanning. """
+        return not self.found_location
+
+    def verify(self, file_hash=None):
+        """ Verify the slice we have fetched is the correct data,
+            using the sum taken while downloading when given. """
+        if file_hash:
+            return check_download(self.log, self.target(), self.slice_sum, file_hash)
         return check_complete(self.log, self.target(), self.slice_sum)
 
-    def download_callback_success(self, ign):
+    def download_callback_success(self, file_hash):
         """ Callback entry point for when self.get() is successful. """
-        if self.verify():
+        if self.verify(file_hash):
             self.download_tries += 1
             self.log.status(_("Successfully downloaded jigdo slice %s" % self.filename))
-            self.finished = True
-            self.template.notify_slice_done()
+            self.data_complete()
             self.log.debug(_("Ending download event for %s" % self.filename))
         else:
             self.log.status(_("Download for %s does not match required file." % self.filename))
+            # Don't resume from bad data.
+            remove_file(self.log, self.target())
             self.download_callback_failure(_("Checksum failed!"))
 
+    def data_complete(self):
+        """ Our data is on disk and verified, let the template know. """
+        self.set_finished(True)
+        self.template.notify_slice_done()
+
+    def set_finished(self, finished):
+        """ Mark our data as there or not, keeping the template's
+            bookkeeping up to date. """
+        self.finished = finished
+        self.template.slice_state_changed(self)
+
     def download_callback_failure(self, ign):
         """ Callback entry point for when self.get() fails. """
         self.download_tries += 1
+        self.current_source = None
         self.log.warning(_("Failed to download %s: \n\t%s" % ( self.filename,
                                                              ign )))
         if self.download_tries >= self.settings.max_download_attempts:
@@ -758,12 +1166,22 @@ class JigdoImageSlice:
             self.async.request_download(self)
         self.log.debug(_("Failed download of %s, added new task to try again." % self.filename))
 
-    def queue_download(self):
+    def stuff_failed(self):
+        """ The data could not be put into the image, fetch it again. """
+        self.fs_location = os.path.join(self.target_location, self.filename)
+        self.fs_offset = None
+        self.set_finished(False)
+        self.download_callback_failure(_("Could not be added to the image."))
+
+    def queue_download(self, complete=None):
         """ Queue the self.get() in the async.
-            First check to see if the file is already there and is complete. """
-        if check_complete(self.log, self.fs_location, self.slice_sum):
+            complete tells if the file is already there and is complete,
+            if it is not known yet it is checked first. """
+        if complete is None:
+            complete = check_complete(self.log, self.fs_location, self.slice_sum)
+        if complete:
             self.log.status(_("Requested data %s was found and is complete." % self.filename))
-            self.download_callback_success(None)
+            self.data_complete()
         else:
             self.async.request_download(self)
 
@@ -776,15 +1194,50 @@ class JigdoImageSlice:
             attempt = self.download_tries + 1
         self.log.status(_("Adding a task to download: %s (attempt: %s)" % \
                        (self.filename, attempt)))
-        return self.async.download_object(self)
+        self.discard_unresumable()
+        segments = self.segment_count()
+        if segments > 1:
+            urls = [self.source()] + \
+                   self.repo.get_urls( self.filename, segments - 1,
+                                       use_only_servers = self.servers_only() )
+            urls = [url for url in urls if url]
+            if len(urls) > 1:
+                return self.async.download_segmented(self, urls)
+        return self.async.download_object(self, resume=True)
+
+    def discard_unresumable(self):
+        """ Remove a target that is already full size. It has not passed
+            its check, most likely it is the sparse file of an interrupted
+            segmented download, and a resume would have nothing to ask for. """
+        target = self.target()
+        if os.path.isfile(target) and os.path.getsize(target) >= self.size:
+            self.log.debug(_("Not resuming %s, it is full size but incomplete." % target))
+            remove_file(self.log, target)
+
+    def segment_count(self):
+        """ Return how many byte ranges to fetch this slice in at once.
+            Slices we already have part of are resumed instead. """
+        if not self.async.can_segment(): return 1
+        if os.path.isfile(self.target()) and os.path.getsize(self.target()): return 1
+        return max(1, min(self.settings.download_segments,
+                          self.size / (self.settings.segment_size * M)))
+
+    def hedge_source(self):
+        """ Return a source we have not tried, to race the running
+            download with, or None. """
+        return self.repo.get_url( self.filename,
+                                  use_only_servers = self.servers_only() )
+
+    def servers_only(self):
+        """ Return True if only baseurls should be tried now. """
+        return self.settings.servers_only or \
+               (self.download_tries >= self.settings.fallback_number)
  
     def new_source(self):
         """ Populate self.current_source with something we have not tried. """
         url = None
-        servers_only = self.settings.servers_only
-        if (self.download_tries >= self.settings.fallback_number): servers_only = True
         url = self.repo.get_url( self.filename,
-                                 use_only_servers = servers_only)
+                                 use_only_servers = self.servers_only())
         if not url:
            self.download_tries = self.settings.max_download_attempts
         else:
@@ -792,22 +1245,70 @@ class JigdoImageSlice:
 
 class JigdoScanTarget:
     """ A definition of where to look for existing bits. """
-    def __init__(self, log, settings, location, needed_files, is_iso=False):
+    def __init__(self, log, async, settings, location, needed_slices, is_iso=False):
         self.log = log
+        self.async = async
         self.settings = settings
         self.location = location
-        self.mounted = False
-        self.mount_location = ""
         self.is_iso = is_iso
-        self.needed_files = needed_files
+        self.needed_slices = needed_slices # {slice_sum: JigdoImageSlice(),}
         # Make location absolute:
         self.location = os.path.abspath(self.location)
 
     def run_scan(self):
-        """ Scan a given location for needed file names and update the slice
-            object with the found location for later use. """
-        if self.is_iso: self.mount()
+        """ Scan a given location for needed files and update the slice
+            object with the found location for later use.
+            The found files are checked in the async's hashing pool, return
+            a Deferred firing when they all have been. """
         self.log.info(_("Scanning %s for needed files..." % self.location))
+        if self.is_iso:
+            # Reading the directory tree is blocking I/O too.
+            d = self.async.hasher.run(IsoReader(self.log, self.location).extents)
+            d.addCallbacks(self.scan_iso, self.scan_iso_failed)
+            return d
+        if self.async.scan_index:
+            d = self.async.index_scan_root(self.location)
+            d.addCallback(self.scan_index_ready)
+            return d
+        if self.settings.scan_by_content:
+            return self.scan_by_content()
+        return self.scan_by_name()
+
+    def scan_index_ready(self, ign):
+        """ Callback entry point for when the scan index is up to date.
+            Needed data already summed in this or an earlier run is looked
+            up directly, files not summed yet are summed if they are at the
+            path (or with --scan-content, of the size) of a needed slice. """
+        index = self.async.scan_index
+        for target_slice in self.needed_slices.values():
+            if target_slice.finished: continue
+            found_target = index.lookup(self.location, target_slice.slice_sum)
+            if found_target: self.found(target_slice, found_target)
+        unhashed = index.unhashed(self.location)
+        wanted = {}
+        for target_slice in self.needed_slices.values():
+            if target_slice.finished: continue
+            if self.settings.scan_by_content:
+                wanted[target_slice.size] = True
+            elif unhashed.has_key(target_slice.filename):
+                wanted[target_slice.filename] = True
+        if self.settings.scan_by_content:
+            candidates = [path for (path, size) in unhashed.items() if wanted.has_key(size)]
+        else:
+            candidates = wanted.keys()
+        self.log.debug(_("%s files in %s need to be summed." % (len(candidates), self.location)))
+        d = defer.DeferredList([self.async.index_hash_file(self.location, path) \
+                                for path in candidates])
+        d.addCallback(self.async.hasher.batch_results)
+        d.addCallback(self.scan_hashed, [os.path.join(self.location, path) for path in candidates])
+        return d
+
+    def scan_by_name(self):
+        """ Look for files at the same path as in the [Parts] section. """
+        needed_files = {}
+        for s in self.needed_slices.values():
+            needed_files[ s.filename ] = s
+        candidates = [] # [(found_target, target_slice),]
         for (path, directories, files) in os.walk(self.location):
             for name in files:
                 try:
@@ -815,38 +1316,94 @@ class JigdoScanTarget:
                     # This will likely break... a lot.
                     target_name = os.path.join(path, name).split(self.location)[1].strip('/')
                     # / hack, or is it? ;-)
-                    target_slice = self.needed_files[target_name]
+                    target_slice = needed_files[target_name]
                     self.log.debug(_("Found file %s checking match..." % name))
-                    found_target = os.path.join(path, name)
-                    if check_complete(self.log, found_target, target_slice.slice_sum):
-                        self.log.info(_("Found a matching file during scan: %s" % name))
-                        target_slice.fs_location = found_target
-                        target_slice.finished = True
-                    else:
-                        self.log.info(_("Found a matching file, but it did not sum: %s" % name))
+                    candidates.append((os.path.join(path, name), target_slice))
                 except KeyError:
                     # We don't need this file, hopefully
                     self.log.debug(_("Ignoring non-matching file %s" % name))
-
-    def mount(self):
-        """ Mount the ISO. """
-        if self.mounted: return
-        self.mount_location = os.path.join(self.settings.download_storage,
-                                           "mounts",
-                                           os.path.basename(self.location))
-        check_directory(self.log, self.mount_location)
-        mount_command = ["fuseiso",
-                         "-p",
-                         self.location,
-                         self.mount_location]
-        self.log.debug(_("Mounting %s at %s ..." % (self.location, self.mount_location)))
-        run_command( self.log, self.settings, mount_command )
-        self.mounted = True
-        self.location = self.mount_location
-
-    def unmount(self):
-        """ Un-Mount the ISO. """
-        if not self.mounted: return
-        umount_command = ["fusermount", "-u", self.mount_location]
-        run_command( self.log, self.settings, umount_command )
-
+        d = self.async.hasher.check_batch([(found_target, candidate.slice_sum) \
+                                           for (found_target, candidate) in candidates])
+        d.addCallback(self.scan_checked, candidates)
+        return d
+
+    def scan_checked(self, results, candidates):
+        """ Callback entry point for when the found files have been checked. """
+        for ((found_target, target_slice), matches) in zip(candidates, results):
+            name = os.path.basename(found_target)
+            if target_slice.finished: continue
+            if matches:
+                self.found(target_slice, found_target)
+            else:
+                self.log.info(_("Found a matching file, but it did not sum: %s" % name))
+
+    def scan_by_content(self):
+        """ Look for files by what they contain, wherever they are. Only files
+            the size of a needed slice are summed. """
+        needed_sizes = {}
+        for s in self.needed_slices.values():
+            if not s.finished: needed_sizes[s.size] = True
+        candidates = [] # [found_target,]
+        for (path, directories, files) in os.walk(self.location):
+            for name in files:
+                found_target = os.path.join(path, name)
+                try:
+                    if not needed_sizes.has_key(os.path.getsize(found_target)): continue
+                except OSError:
+                    continue
+                self.log.debug(_("Found file %s of a needed size, checking match..." % name))
+                candidates.append(found_target)
+        d = self.async.hasher.hash_batch(candidates)
+        d.addCallback(self.scan_hashed, candidates)
+        return d
+
+    def scan_hashed(self, results, candidates):
+        """ Callback entry point for when the candidate files have been summed. """
+        for (found_target, found_hash) in zip(candidates, results):
+            target_slice = self.needed_slices.get(found_hash)
+            if target_slice and not target_slice.finished:
+                self.found(target_slice, found_target)
+
+    def scan_iso(self, extents):
+        """ Callback entry point for when the ISO's directory has been read.
+            Pick the extents that may be needed data, by name or by size,
+            and sum them in place. """
+        if self.settings.scan_by_content:
+            needed_sizes = {}
+            for s in self.needed_slices.values():
+                if not s.finished: needed_sizes[s.size] = True
+            candidates = [e for e in extents if needed_sizes.has_key(e.size)]
+        else:
+            needed_files = {}
+            for s in self.needed_slices.values():
+                needed_files[ s.filename ] = s
+            candidates = [e for e in extents if needed_files.has_key(e.path)]
+        self.log.debug(_("%s of %s files in %s may be needed, checking..." % \
+                         (len(candidates), len(extents), self.location)))
+        d = self.async.hasher.hash_extents([(self.location, e.offset, e.size) \
+                                            for e in candidates])
+        d.addCallback(self.scan_iso_hashed, candidates)
+        return d
+
+    def scan_iso_failed(self, failure):
+        """ Errback entry point for when the ISO could not be read. """
+        self.log.error(_("Could not scan %s: %s" % (self.location, failure.getErrorMessage())))
+
+    def scan_iso_hashed(self, results, candidates):
+        """ Callback entry point for when the candidate extents have been summed. """
+        for (extent, found_hash) in zip(candidates, results):
+            target_slice = self.needed_slices.get(found_hash)
+            if target_slice and not target_slice.finished:
+                self.found(target_slice, self.location, extent.offset)
+
+    def found(self, target_slice, found_target, offset=None):
+        """ found_target has been verified to be the data for target_slice.
+            If the data is inside found_target, offset is where it starts. """
+        if offset is None:
+            self.log.info(_("Found a matching file during scan: %s" % found_target))
+        else:
+            self.log.info(_("Found a matching file during scan: %s at offset %s" % \
+                            (found_target, offset)))
+        target_slice.fs_location = found_target
+        target_slice.fs_offset = offset
+        target_slice.set_finished(True)
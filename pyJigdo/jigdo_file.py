@@ -17,11 +17,13 @@
 
 """
 jigdo-file calls and functions. These need to be implemented directly, without
-shelling out for this information. For now, we just shell out to jigdo-file.
+shelling out for this information. Templates are read natively by
+pyJigdo.template, image creation still shells out to jigdo-file.
 """
 
 import os
 from pyJigdo.util import check_directory, run_command
+from pyJigdo.template import JigdoTemplateReader, TemplateMatchedFile, TemplateError
 
 from pyJigdo.translate import _, N_
 
@@ -36,33 +38,53 @@ class execJigdoFile:
         self.jigdo_file = jigdo_file
         self.jigdo_env = {'PATH': os.getenv('PATH')}
 
-    def get_template_data(self, template_file):
-        """ Return the template data from the given template_file. """
-        # TODO: Return an object, not just the output.
-        return run_command( self.log,
-                            self.settings,
-                            ["jigdo-file", "ls", "--template", template_file],
-                            env=self.jigdo_env,
-                            inshell=True )
-
-    def stuff_bits_into_image(self, jigdo_image, file, destroy=False):
-        """ Put given file into given jigdo_image.
-            If destroy, the bits will be removed after being added to the
-            target image. """
-        self.log.debug(_("Stuffing %s into %s ..." % \
-                        ( file, os.path.basename(jigdo_image.location) )))
+    def stuff_bits_into_image(self, jigdo_image, files):
+        """ Put all given files into given jigdo_image with one run of
+            jigdo-file, handing it the list of files to use.
+            Return a dictionary of the md5 sums that are now in the image. """
+        if not files: return {}
+        self.log.debug(_("Stuffing %s files into %s ..." % \
+                        ( len(files), os.path.basename(jigdo_image.location) )))
+        check_directory(self.log, self.settings.download_storage)
+        files_from = os.path.join( self.settings.download_storage,
+                                   "%s.files" % os.path.basename(jigdo_image.location) )
+        f = open(files_from, "w")
+        try:
+            f.write("\n".join(files))
+            f.write("\n")
+        finally:
+            f.close()
         stuff_command = [ "jigdo-file", "make-image",
                           "--image", jigdo_image.location,
                           "--template", jigdo_image.fs_location,
                           "--jigdo", jigdo_image.jigdo_definition.file_name,
                           "-r", "quiet",
                           "--force",
-                          file ]
+                          "--files-from", files_from ]
         run_command( self.log,
                      self.settings,
                      stuff_command,
                      env=self.jigdo_env,
                      inshell=True )
-        if destroy: os.remove(file)
-
+        os.remove(files_from)
+        return self.files_in_image(jigdo_image)
 
+    def files_in_image(self, jigdo_image):
+        """ Return a dictionary of the md5 sums jigdo-file has written
+            into the (partial) image. """
+        in_image = {}
+        if os.access(jigdo_image.location, os.R_OK):
+            # The image is complete, so everything is in it.
+            template_target = jigdo_image.fs_location
+        elif os.access(jigdo_image.tmp_location, os.R_OK):
+            template_target = jigdo_image.tmp_location
+        else:
+            return in_image
+        try:
+            for record in JigdoTemplateReader(self.log, template_target).entries():
+                if isinstance(record, TemplateMatchedFile) and \
+                   (record.written or template_target == jigdo_image.fs_location):
+                    in_image[record.md5] = True
+        except (TemplateError, IOError), e:
+            self.log.error(_("Could not read %s: %s" % (template_target, e)))
+        return in_image
@@ -0,0 +1,126 @@
+#
+# Copyright 2007-2009 Fedora Unity Project (http://fedoraunity.org)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Live statistics about the mirrors we download from, used to send more
+work to the fast and reliable ones.
+"""
+
+import time, random, urlparse
+
+from pyJigdo.translate import _, N_
+
+# Weight of the newest sample in the moving averages.
+EWMA_WEIGHT = 0.3
+# The size of file we score mirrors for, most slices are small packages.
+TYPICAL_SIZE = 1024*1024
+
+def ewma(average, sample):
+    """ Return the moving average after adding sample. """
+    if average is None: return sample
+    return (1 - EWMA_WEIGHT) * average + EWMA_WEIGHT * sample
+
+class MirrorStats:
+    """ Statistics for one mirror host: moving averages of the throughput
+        (bytes per second), time to first byte (seconds) and error rate. """
+    def __init__(self, host):
+        self.host = host
+        self.throughput = None
+        self.ttfb = None
+        self.error_rate = 0.0
+        self.active = 0
+        self.requests = 0
+        self.errors = 0
+
+    def __str__(self):
+        if self.throughput is None:
+            throughput = "-"
+        else:
+            throughput = "%.0f KB/s" % (self.throughput / 1024)
+        if self.ttfb is None:
+            ttfb = "-"
+        else:
+            ttfb = "%.2fs" % self.ttfb
+        return _("%s: %s, first byte %s, %s of %s requests failed" % \
+                 (self.host, throughput, ttfb, self.errors, self.requests))
+
+    def start(self):
+        """ A request to this mirror is starting, return its start time. """
+        self.active += 1
+        self.requests += 1
+        return time.time()
+
+    def first_byte(self, started):
+        """ The response to the request started at started has arrived. """
+        self.ttfb = ewma(self.ttfb, time.time() - started)
+
+    def done(self, started, size):
+        """ The request started at started got size bytes. """
+        self.active -= 1
+        elapsed = max(time.time() - started, 0.001)
+        self.throughput = ewma(self.throughput, size / elapsed)
+        self.error_rate = ewma(self.error_rate, 0.0)
+
+    def skipped(self, started):
+        """ The request started at started ended with nothing to judge
+            this mirror by, such as when we stopped it ourselves. """
+        self.active -= 1
+
+    def failed(self, started):
+        """ The request started at started failed. """
+        self.active -= 1
+        self.errors += 1
+        self.error_rate = ewma(self.error_rate, 1.0)
+
+    def cost(self):
+        """ Return the expected time to get a typical file from this mirror,
+            counting retries and the requests it is already busy with.
+            Mirrors we know nothing about yet cost nothing, so they get tried. """
+        if self.throughput is None: return 0.0
+        cost = (self.ttfb or 0.0) + TYPICAL_SIZE / self.throughput
+        cost = cost / max(1.0 - self.error_rate, 0.05)
+        return cost * (1 + self.active)
+
+class MirrorScores:
+    """ The MirrorStats() of all mirror hosts, shared by all repos. """
+    def __init__(self):
+        self.mirrors = {} # {host: MirrorStats(),}
+
+    def __str__(self):
+        return "\n".join([str(m) for m in self.mirrors.values()])
+
+    def get(self, url):
+        """ Return the MirrorStats() for the host of url. """
+        host = urlparse.urlsplit(url)[1]
+        try:
+            return self.mirrors[host]
+        except KeyError:
+            self.mirrors[host] = MirrorStats(host)
+            return self.mirrors[host]
+
+    def choose(self, urls):
+        """ Pick one of urls, using the power of two choices: the cheaper
+            of two picked at random. This keeps most of the work on good
+            mirrors without piling it all onto the single best one. """
+        if len(urls) <= 2:
+            candidates = urls
+        else:
+            candidates = random.sample(urls, 2)
+        best = candidates[0]
+        for url in candidates[1:]:
+            if self.get(url).cost() < self.get(best).cost(): best = url
+        return best
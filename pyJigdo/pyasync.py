@@ -16,16 +16,53 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 from twisted.internet import reactor
-from twisted.internet import defer, task
+from twisted.internet import defer, task, threads
 from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.internet.error import TimeoutError
+from twisted.python.threadpool import ThreadPool
 from twisted.web.client import *
+from twisted.web import error
+try:
+    # Twisted 12.1+, keep-alive connections.
+    from twisted.web.client import Agent, RedirectAgent, HTTPConnectionPool, ResponseDone
+    from twisted.web.http import PotentialDataLoss
+    from twisted.web.http_headers import Headers
+    from twisted.internet.protocol import Protocol
+except ImportError:
+    Agent = None
 from constants import PYJIGDO_USER_AGENT
 from jigdo_file import execJigdoFile
-from pyJigdo.util import check_directory
-import os, types, time
+from pyJigdo.mirrors import MirrorScores
+from pyJigdo.util import check_directory, check_complete, file_hash, close_hash_cache, \
+                         jigdo_md5, md5_hashlib, partial_hash, remove_file, \
+                         read_validators, save_validators
+import os, types, time, threading, Queue, urlparse, heapq, itertools
 
 from pyJigdo.translate import _, N_
 
+# Seconds between reports of the download queue.
+REPORT_INTERVAL = 10
+# Seconds between checks for stalled or too slow downloads.
+WATCHDOG_INTERVAL = 1
+# Seconds to wait before the first retry of a download, this doubles
+# with each try up to RETRY_BACKOFF_MAX.
+RETRY_BACKOFF = 1
+RETRY_BACKOFF_MAX = 60
+# Response headers saved to make later requests conditional, and the
+# request headers they are sent back in.
+CONDITIONAL_HEADERS = { "ETag": "If-None-Match",
+                        "Last-Modified": "If-Modified-Since" }
+# How far past downloads held back by a limit the scheduler looks for work.
+SCHEDULE_LOOKAHEAD = 64
+# Tuning of the number of downloads with --threads auto: every TUNE_INTERVAL
+# seconds add one, or cut them by TUNE_DECREASE when more than TUNE_MAX_ERRORS
+# of transfers failed or throughput fell by more than TUNE_TOLERANCE.
+TUNE_INTERVAL = 5
+TUNE_MAX_ERRORS = 0.2
+TUNE_TOLERANCE = 0.1
+TUNE_DECREASE = 0.75
+
 
 # FIXME: the jigdoHTTPDownloader is a super hack.
 # This hack requires us to depend on a very specific version
@@ -44,46 +81,474 @@ class jigdoHTTPDownloader(HTTPDownloader):
     # For the 8.2.0 packages: http://jsteffan.fedorapeople.org/SRPMS/
     # These will go into Fedora project ASAP.
 
-    # We have commented this out because it's an overhead we don't
-    # want to deal with right now. We will be getting pyjigdo running
-    # with 8.2.0 and will then worry about supporting user-defined
-    # timeout values.
-
-    #def __init__(self, url, fileOrName,
-    #             method='GET', postdata=None, headers=None,
-    #             agent="Twisted client", supportPartial=0,
-    #             timeout=0):
-    #    self.requestedPartial = 0
-    #    if isinstance(fileOrName, types.StringTypes):
-    #        self.fileName = fileOrName
-    #        self.file = None
-    #        if supportPartial and os.path.exists(self.fileName):
-    #            fileLength = os.path.getsize(self.fileName)
-    #            if fileLength:
-    #                self.requestedPartial = fileLength
-    #                if headers == None:
-    #                    headers = {}
-    #                headers["range"] = "bytes=%d-" % fileLength
-    #    else:
-    #        self.file = fileOrName
-    #    HTTPClientFactory.__init__(self, url, method=method, postdata=postdata,
-    #                               headers=headers, agent=agent, timeout=timeout)
-    #    self.deferred = defer.Deferred()
-    #    self.waiting = 1
+    def __init__(self, *args, **kwargs):
+        """ seed_md5, if given, is the running md5 of the data already in
+            the file, it is carried on when the server resumes it
+            (with supportPartial). """
+        self.seed_md5 = kwargs.pop("seed_md5", None)
+        self.mirror = kwargs.pop("mirror", None) # (MirrorStats(), start time)
+        self.watch = kwargs.pop("watch", None) # TransferWatch()
+        HTTPDownloader.__init__(self, *args, **kwargs)
+        self.md5 = md5_hashlib.md5()
+
+    def gotHeaders(self, headers):
+        """ A 416 has no range to parse, let it fail as a 416. """
+        if self.requestedPartial and self.status == "416":
+            return HTTPClientFactory.gotHeaders(self, headers)
+        HTTPDownloader.gotHeaders(self, headers)
+
+    def pageStart(self, partialContent):
+        """ Called on page download start, start a fresh sum, or carry on
+            the sum of what we have when resuming. """
+        if partialContent and self.seed_md5:
+            self.md5 = self.seed_md5
+        else:
+            self.md5 = md5_hashlib.md5()
+        if self.mirror: self.mirror[0].first_byte(self.mirror[1])
+        HTTPDownloader.pageStart(self, partialContent)
+
+    def pagePart(self, data):
+        """ Sum each chunk of data as it is written, so the download
+            never has to be read back to be verified. """
+        if self.file: self.md5.update(data)
+        if self.watch:
+            connector = getattr(self, "jigdo_connector", None)
+            self.watch.data(len(data), getattr(connector, "transport", None))
+        HTTPDownloader.pagePart(self, data)
+
+    def digest(self):
+        """ Return the jigdo md5 sum of what has been downloaded. """
+        return jigdo_md5(self.md5.digest())
+
+if Agent:
+    class jigdoConnectionPool(HTTPConnectionPool):
+        """ A keep-alive connection pool that counts the connections
+            it has to make, so we can tell how many were reused. """
+        connections_made = 0
+
+        def _newConnection(self, key, endpoint):
+            self.connections_made += 1
+            return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    class jigdoBodyWriter(Protocol):
+        """ Write a response body to a file, summing it as it arrives.
+            finished fires with the jigdo md5 sum of the data. """
+        def __init__(self, file, finished, md5=None, watch=None):
+            self.file = file
+            self.finished = finished
+            self.md5 = md5 or md5_hashlib.md5()
+            self.watch = watch
+
+        def dataReceived(self, data):
+            self.file.write(data)
+            self.md5.update(data)
+            if self.watch: self.watch.data(len(data), self.transport)
+
+        def connectionLost(self, reason):
+            self.file.close()
+            if reason.check(ResponseDone, PotentialDataLoss):
+                self.finished.callback(jigdo_md5(self.md5.digest()))
+            else:
+                self.finished.errback(reason)
+
+    class jigdoBodyReader(Protocol):
+        """ Collect a response body, finished fires with the data. """
+        def __init__(self, finished, watch=None):
+            self.finished = finished
+            self.data = []
+            self.watch = watch
+
+        def dataReceived(self, data):
+            self.data.append(data)
+            if self.watch: self.watch.data(len(data), self.transport)
+
+        def connectionLost(self, reason):
+            if reason.check(ResponseDone, PotentialDataLoss):
+                self.finished.callback("".join(self.data))
+            else:
+                self.finished.errback(reason)
+
+    class jigdoSegment(Protocol):
+        """ One byte range (start to end, inclusive) of a segmented download,
+            written in place into file. finished fires when it is all there. """
+        def __init__(self, url, file, start, end):
+            self.url = url
+            self.file = file
+            self.start = start
+            self.end = end
+            self.received = 0
+            self.aborted = False
+            self.f = None
+            self.watch = None # TransferWatch()
+            self.finished = defer.Deferred()
+
+        def connectionMade(self):
+            if self.aborted:
+                self.transport.stopProducing()
+                return
+            self.f = open(self.file, "r+b")
+            self.f.seek(self.start)
+
+        def dataReceived(self, data):
+            if not self.f: return
+            self.f.write(data)
+            self.received += len(data)
+            if self.watch: self.watch.data(len(data), self.transport)
+
+        def connectionLost(self, reason):
+            if self.f: self.f.close()
+            if self.aborted:
+                # Nobody is waiting on us any more.
+                self.finished.callback(None)
+            elif not reason.check(ResponseDone, PotentialDataLoss):
+                self.finished.errback(reason)
+            elif self.received != self.end - self.start + 1:
+                self.finished.errback(IOError(_("Got %s bytes of %s-%s from %s" % \
+                                      (self.received, self.start, self.end, self.url))))
+            else:
+                self.finished.callback(None)
+
+        def abort(self):
+            """ Stop this segment, dropping its connection if it has one. """
+            self.aborted = True
+            if self.transport: self.transport.stopProducing()
+
+class RateLimiter:
+    """ A token bucket shared by all transfers, letting through rate bytes
+        per second on average, in bursts of up to a second's worth. """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.time()
+
+    def take(self, length):
+        """ length bytes have arrived, return how many seconds the transfer
+            should wait before reading more. """
+        now = time.time()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= length
+        if self.tokens >= 0: return 0
+        return -self.tokens / self.rate
+
+class TransferWatch:
+    """ The progress of one transfer, checked by the reactor's watchdog.
+        aborter is called to stop the transfer, it changes as the
+        transfer goes from waiting for a response to reading the body.
+        With a limiter, the transfer is paused when it gets ahead of
+        the RateLimiter(). """
+    def __init__(self, url, file=None, limiter=None):
+        self.url = url
+        self.file = file
+        self.limiter = limiter
+        self.started = time.time()
+        self.last_data = self.started
+        self.received = 0
+        self.window_start = self.started
+        self.window_received = 0
+        self.throttled = False # Paused by the limiter in this window.
+        self.unmeasured = False # Done without a body to judge the mirror by.
+        self.resume = None # reactor.callLater(transport.resumeProducing)
+        self.reason = None
+        self.aborter = None
+
+    def data(self, length, transport=None):
+        """ length bytes have arrived over transport. """
+        self.received += length
+        self.last_data = time.time()
+        if not self.limiter or not transport: return
+        delay = self.limiter.take(length)
+        if not delay: return
+        # We are waiting on ourselves, not on the mirror.
+        self.last_data += delay
+        self.throttled = True
+        if self.resume and self.resume.active():
+            self.resume.reset(delay)
+        else:
+            transport.pauseProducing()
+            self.resume = reactor.callLater(delay, transport.resumeProducing)
+
+    def abort(self, reason):
+        """ Stop the transfer, because of reason. """
+        self.reason = reason
+        if self.aborter: self.aborter()
+
+class HedgedTransfer:
+    """ A download of jigdo_object to file that may be raced by a second
+        copy, from another source to hedge_file. The first copy to arrive
+        with the expected sum is kept, deferred fires with its sum (or
+        with how the last copy failed). """
+    def __init__(self, jigdo_object, file, expected):
+        self.jigdo_object = jigdo_object
+        self.file = file
+        self.hedge_file = file + ".hedge"
+        self.expected = expected
+        self.started = time.time()
+        self.running = 1
+        self.hedged = False
+        self.done = False
+        self.deferred = defer.Deferred()
+
+class TransferAborted(Exception):
+    """ A transfer was stopped by the watchdog. """
+    def __init__(self, url, reason):
+        Exception.__init__(self, _("%s: %s" % (reason, url)))
+        self.url = url
+        self.reason = reason
+
+class RangeNotHonoured(Exception):
+    """ A server sent something other than the byte range we asked for. """
+    def __init__(self, url):
+        Exception.__init__(self, _("%s does not honour byte ranges" % url))
+        self.url = url
+
+class PyJigdoWorker:
+    """ A worker thread with a bounded queue, for blocking work (such as
+        stuffing data into images) that must not stall the reactor.
+        Results are handed back to the reactor thread. """
+
+    def __init__(self, log, reactor, queue_size=4):
+        self.log = log
+        self.reactor = reactor
+        self.queue = Queue.Queue(queue_size)
+        self.thread = None
+        self.pending = 0 # Jobs queued or running, only touched by the reactor.
+        self.idle_waiters = [] # [Deferred(),]
+
+    def start(self):
+        """ Start the worker thread. """
+        if self.thread: return
+        self.thread = threading.Thread(target=self.run, name="pyjigdo-worker")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """ Ask the worker thread to exit once the queue is done. """
+        if not self.thread: return
+        self.queue.put(None)
+        self.thread = None
+
+    def submit(self, function, *args):
+        """ Run function(*args) in the worker thread. Return a Deferred
+            firing with the result in the reactor thread, or None if
+            the queue is full and the caller should try again later. """
+        self.start()
+        d = defer.Deferred()
+        try:
+            self.queue.put_nowait((function, args, d))
+        except Queue.Full:
+            return None
+        self.pending += 1
+        return d
+
+    def busy(self):
+        """ Return True if there are jobs queued or running. """
+        return self.pending > 0
+
+    def full(self):
+        """ Return True if submit() would turn a job away. """
+        return self.queue.full()
+
+    def wait_idle(self):
+        """ Return a Deferred firing once all jobs are done. """
+        d = defer.Deferred()
+        if self.busy():
+            self.idle_waiters.append(d)
+        else:
+            d.callback(None)
+        return d
+
+    def run(self):
+        """ The worker thread: run jobs until told to stop. """
+        while True:
+            job = self.queue.get()
+            if job is None: break
+            (function, args, d) = job
+            try:
+                result = function(*args)
+            except:
+                result = Failure()
+            self.reactor.callFromThread(self.job_done, d, result)
+
+    def job_done(self, d, result):
+        """ Hand the result of a job back, in the reactor thread. """
+        self.pending -= 1
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+        if not self.busy():
+            waiters = self.idle_waiters
+            self.idle_waiters = []
+            for waiter in waiters: waiter.callback(None)
+
+class PyJigdoHasher:
+    """ A pool of threads to check file sums in, so verifying lots of
+        existing data scales with the cores and disks we have. """
+
+    def __init__(self, log, reactor, workers=4):
+        self.log = log
+        self.reactor = reactor
+        self.pool = ThreadPool(minthreads=0, maxthreads=workers, name="pyjigdo-hasher")
+        self.pending = 0 # Checks queued or running, only touched by the reactor.
+        self.idle_waiters = [] # [Deferred(),]
+
+    def start(self):
+        """ Start the thread pool. """
+        if not self.pool.started: self.pool.start()
+
+    def stop(self):
+        """ Stop the thread pool. """
+        if self.pool.started: self.pool.stop()
+
+    def run(self, function, *args):
+        """ Run function(*args) in the pool. Return a Deferred firing
+            with the result in the reactor thread. """
+        self.start()
+        self.pending += 1
+        d = threads.deferToThreadPool(self.reactor, self.pool, function, *args)
+        d.addBoth(self.check_done)
+        return d
+
+    def check(self, file, hash):
+        """ Check if file is on disk and matches hash. Return a Deferred
+            firing with True or False. """
+        return self.run(check_complete, self.log, file, hash)
+
+    def check_batch(self, batch):
+        """ Check a batch of (file, hash). Return a Deferred firing with
+            a list of True or False, in the order of the batch. """
+        d = defer.DeferredList([self.check(file, hash) for (file, hash) in batch])
+        d.addCallback(self.batch_results)
+        return d
+
+    def hash_batch(self, files):
+        """ Sum a batch of files. Return a Deferred firing with a list of
+            their jigdo md5 sums (None if unreadable), in the order given. """
+        d = defer.DeferredList([self.run(file_hash, self.log, file) for file in files])
+        d.addCallback(self.batch_results)
+        return d
+
+    def hash_extents(self, extents):
+        """ Like hash_batch(), for a list of (file, offset, size) pieces of files. """
+        d = defer.DeferredList([self.run(file_hash, self.log, file, offset, size)
+                                for (file, offset, size) in extents])
+        d.addCallback(self.batch_results)
+        return d
+
+    def batch_results(self, results):
+        """ Turn DeferredList results into a plain list of results. """
+        return [success and result for (success, result) in results]
+
+    def check_done(self, result):
+        """ A check is done, in the reactor thread. """
+        self.pending -= 1
+        if not self.busy():
+            # Let the callbacks of this check run (and maybe queue more
+            # checks) before deciding we are idle.
+            self.reactor.callLater(0, self.notify_idle)
+        return result
+
+    def notify_idle(self):
+        """ Fire the wait_idle() Deferreds, if we are still idle. """
+        if self.busy(): return
+        waiters = self.idle_waiters
+        self.idle_waiters = []
+        for waiter in waiters: waiter.callback(None)
+
+    def busy(self):
+        """ Return True if there are checks queued or running. """
+        return self.pending > 0
+
+    def wait_idle(self):
+        """ Return a Deferred firing once all checks are done. """
+        d = defer.Deferred()
+        if self.busy():
+            self.idle_waiters.append(d)
+        else:
+            d.callback(None)
+        return d
 
 class PyJigdoReactor:
     """ The pyJigdo Reactor. Used for async operations. """
 
-    def __init__(self, log, threads=1, timeout=10):
+    def __init__(self, log, threads=1, timeout=10, hash_workers=4, slice_order="fifo",
+                 idle_connections=4, idle_timeout=30, min_speed=0, min_speed_time=60,
+                 hedge_after=0, host_limit=0, rate_limit=0, repo_limits={},
+                 thread_bounds=None):
         """ Our main async gears for connecting to remote sites
-            and downloading the data that we need. """
+            and downloading the data that we need.
+            When twisted is new enough, connections are kept open for
+            reuse, at most idle_connections idle ones per host (this does
+            not cap concurrent downloads, host_limit does), each
+            for at most idle_timeout seconds.
+            Connections taking more than timeout seconds to connect,
+            transfers getting no data for timeout seconds and transfers
+            slower than min_speed KB/s over min_speed_time seconds are
+            aborted.
+            When there is nothing left to queue, downloads running for more
+            than hedge_after seconds are raced by a second copy from another
+            source, 0 disables this.
+            At most host_limit downloads (0 for no limit) run from one host
+            at once, and at most repo_limits[label] from one repo. Downloads
+            held back by a limit are passed over for others in the queue.
+            rate_limit caps all downloads together at that many KB/s,
+            0 for no limit.
+            With thread_bounds (low, high), the number of downloads starts
+            at threads and is tuned within those bounds. """
         self.log = log
         self.reactor = reactor
         self.threads = threads
+        self.thread_bounds = thread_bounds
+        self.tuner = None # task.LoopingCall(self.tune_threads)
+        self.bytes_received = 0 # By transfers that are done.
+        self.transfers_done = 0
+        self.transfers_failed = 0
+        self.tune_state = None # (time, bytes, done, failed, throughput) at the last tuning.
         self.timeout = timeout
-        self.pending_downloads = []
+        self.slice_order = slice_order
+        self.min_speed = min_speed
+        self.min_speed_time = min_speed_time
+        self.transfers = {} # {TransferWatch(): True}
+        self.aborts = {} # {reason: count}
+        self.watchdog = None # task.LoopingCall(self.check_transfers)
+        self.hedge_after = hedge_after
+        self.hedgeable = {} # {HedgedTransfer(): True}
+        self.hedges_running = 0
+        self.hedges_started = 0
+        self.hedges_won = 0
+        self.hedge_saved = 0.0 # Estimated seconds saved by winning hedges.
+        self.hedges_estimated = 0 # Winning hedges hedge_saved has an estimate for.
+        self.host_limit = host_limit
+        self.repo_limits = repo_limits # {label: max downloads}
+        self.limited = {} # {("host", host) or ("repo", label): running downloads}
+        self.limiter = None # RateLimiter()
+        if rate_limit: self.limiter = RateLimiter(rate_limit * 1024)
+        self.pending_downloads = [] # heapq of (priority, retry, sequence, object)
+        self.download_sequence = itertools.count()
+        self.delayed_downloads = 0 # Retries waiting out their backoff.
+        self.active_downloads = 0
+        self.started = False
+        self.finish_waiting = False # finish() is waiting on the workers.
+        self.reporter = None # task.LoopingCall(self.report)
         self.base = None # PyJigdoBase()
         self.jigdo_file = None # execJigdoFile()
+        self.stuffer = PyJigdoWorker(self.log, self.reactor)
+        self.hasher = PyJigdoHasher(self.log, self.reactor, workers=hash_workers)
+        self.mirror_stats = MirrorScores()
+        self.pool = None # jigdoConnectionPool()
+        self.agent = None # RedirectAgent()
+        self.requests_made = 0
+        if Agent:
+            self.pool = jigdoConnectionPool(self.reactor, persistent=True)
+            self.pool.maxPersistentPerHost = idle_connections
+            self.pool.cachedConnectionTimeout = idle_timeout
+            self.agent = RedirectAgent(Agent(self.reactor, connectTimeout=timeout, pool=self.pool))
+        else:
+            self.log.debug(_("Twisted has no HTTPConnectionPool, not reusing connections."))
+        self.scan_index = None # ScanIndex(), shared by all scans.
+        self.indexed_roots = {} # {root: True or [waiting Deferred(),]}
+        self.indexed_hashing = {} # {(root, path): [waiting Deferred(),]}
 
     def seed(self, base):
         """ Seed the reactor, assigning the PyJigdoBase() and
@@ -106,96 +571,784 @@ class PyJigdoReactor:
 
     def request_download(self, object):
         """ Add a request that the reactor download given object.
-            Call object.get() to actually fetch the object. """
-        self.pending_downloads.append(object)
-
-    def parallel_get(self, objects, count, *args, **named):
-        """ Run count number of objects.get() at a time. """
-        coop = task.Cooperator()
-        work = self.yield_work(objects)
-        return defer.DeferredList([coop.coiterate(work) for i in xrange(count)])
-
-    def yield_work(self, download_objects):
-        """ Yield the work to be completed. """
-        for download in download_objects:
-            yield download.get()
-
-    def checkpoint(self, ign):
-        """ Check to see if we have anything to do. """
-        self.log.debug(_("Pending Downloads: %s | Download Threads: %s" % \
+            Call object.get() to actually fetch the object.
+            Objects that have been tried before are queued after a backoff,
+            and go after fresh objects of the same priority. """
+        if object.download_tries:
+            delay = min(RETRY_BACKOFF * 2 ** (object.download_tries - 1), RETRY_BACKOFF_MAX)
+            self.log.debug(_("Retrying download in %s seconds." % delay))
+            self.delayed_downloads += 1
+            self.reactor.callLater(delay, self.queue_retry, object)
+            return
+        self.queue_download(object, False)
+
+    def queue_retry(self, object):
+        """ A retry is done waiting, queue it. """
+        self.delayed_downloads -= 1
+        self.queue_download(object, True)
+
+    def queue_download(self, object, retry):
+        """ Put object into the download queue and try to start it. """
+        heapq.heappush(self.pending_downloads,
+                       ( object.download_priority(self.slice_order),
+                         retry,
+                         self.download_sequence.next(),
+                         object ))
+        self.schedule()
+
+    def has_work(self):
+        """ Return True if there is anything left for the reactor to do. """
+        return bool(self.pending_downloads) or bool(self.active_downloads) or \
+               bool(self.delayed_downloads) or self.stuffer.busy() or self.hasher.busy()
+
+    def start(self):
+        """ Start downloading, keeping self.threads downloads running
+            until there is nothing left to download. """
+        self.started = True
+        self.reporter = task.LoopingCall(self.report)
+        self.reporter.start(REPORT_INTERVAL, now=False)
+        self.watchdog = task.LoopingCall(self.check_transfers)
+        self.watchdog.start(WATCHDOG_INTERVAL, now=False)
+        if self.thread_bounds:
+            self.tuner = task.LoopingCall(self.tune_threads)
+            self.tuner.start(TUNE_INTERVAL, now=True)
+        self.schedule()
+
+    def schedule(self):
+        """ Fill any free download slots from the pending downloads,
+            passing over those held back by a host or repo limit.
+            When nothing is running or pending, see if we are done. """
+        if not self.started: return
+        skipped = []
+        while self.pending_downloads and len(skipped) < SCHEDULE_LOOKAHEAD and \
+              self.active_downloads + self.hedges_running < self.threads:
+            entry = heapq.heappop(self.pending_downloads)
+            download = entry[-1]
+            limits = self.download_limits(download.source(), getattr(download, "repo", None))
+            if not self.take_limits(limits):
+                skipped.append(entry)
+                continue
+            self.active_downloads += 1
+            d = defer.maybeDeferred(download.get)
+            d.addBoth(self.download_done, limits)
+        for entry in skipped: heapq.heappush(self.pending_downloads, entry)
+        self.hedge_stragglers()
+        if not self.pending_downloads and not self.active_downloads and \
+           not self.delayed_downloads and not self.finish_waiting:
+            self.finish()
+
+    def download_done(self, result, limits=[]):
+        """ A download slot is free, the download's own callbacks have
+            already run (and may have queued more work). """
+        self.active_downloads -= 1
+        self.release_limits(limits)
+        self.schedule()
+
+    def download_limits(self, url, repo=None):
+        """ Return the limits a download from url, for repo, counts against. """
+        limits = []
+        if url and self.host_limit:
+            limits.append((("host", urlparse.urlsplit(url)[1]), self.host_limit))
+        if repo and self.repo_limits.has_key(repo.label):
+            limits.append((("repo", repo.label), self.repo_limits[repo.label]))
+        return limits
+
+    def take_limits(self, limits):
+        """ If none of limits is reached, count a download against them
+            and return True. """
+        for (key, limit) in limits:
+            if self.limited.get(key, 0) >= limit: return False
+        for (key, limit) in limits:
+            self.limited[key] = self.limited.get(key, 0) + 1
+        return True
+
+    def release_limits(self, limits):
+        """ A download counted against limits is done. """
+        for (key, limit) in limits:
+            self.limited[key] -= 1
+            if not self.limited[key]: del self.limited[key]
+
+    def connection_stats(self):
+        """ Return a summary of how well connections have been reused. """
+        if not self.pool: return _("Connections are not reused.")
+        return _("%s requests over %s connections (%s reused)" % \
+                 ( self.requests_made,
+                   self.pool.connections_made,
+                   self.requests_made - self.pool.connections_made ))
+
+    def report(self):
+        """ Report the state of the download queue. """
+        self.log.info(_("Pending Downloads: %s | Retries Waiting: %s | Active Downloads: %s | Download Threads: %s" % \
                         ( len(self.pending_downloads),
-                          self.base.settings.download_threads )))
-        if self.pending_downloads:
-            downloads = self.get_pending_downloads()
-            r = self.parallel_get( downloads,
-                                   self.base.settings.download_threads )
-            r.addCallback(self.checkpoint)
+                          self.delayed_downloads,
+                          self.active_downloads,
+                          self.threads )))
+        for image in self.selected_images(): self.log.info(image.progress())
+        self.log.debug(self.connection_stats())
+        self.log.debug(_("Mirrors:\n%s" % self.mirror_stats))
+        if self.aborts: self.log.debug(self.abort_stats())
+        if self.hedges_started: self.log.debug(self.hedge_stats())
+
+    def hedge_stats(self):
+        """ Return a summary of the second copies raced against slow downloads. """
+        return _("Raced %s slow downloads, %s second copies won, saving about %.0f seconds on %s of them" % \
+                 (self.hedges_started, self.hedges_won, self.hedge_saved, self.hedges_estimated))
+
+    def abort_stats(self):
+        """ Return a summary of why transfers have been aborted. """
+        return _("Aborted transfers: %s" % \
+                 ", ".join(["%s: %s" % (reason, count) for (reason, count) in self.aborts.items()]))
+
+    def watch_transfer(self, url, file=None):
+        """ Return a TransferWatch() for a transfer from url to file starting now. """
+        watch = TransferWatch(url, file, self.limiter)
+        self.transfers[watch] = True
+        return watch
+
+    def unwatch_transfer(self, result, watch):
+        """ Callback entry point for when a watched transfer is done.
+            If we aborted it, fail with why. """
+        del self.transfers[watch]
+        self.bytes_received += watch.received
+        self.transfers_done += 1
+        if isinstance(result, Failure):
+            # Losing a race is not a sign of trouble.
+            if watch.reason != _("raced"): self.transfers_failed += 1
+            if watch.reason:
+                self.count_abort(watch.reason)
+                return Failure(TransferAborted(watch.url, watch.reason))
+            if result.check(TimeoutError):
+                self.count_abort(_("connect timeout"))
+        return result
+
+    def tune_threads(self):
+        """ Tune self.threads within self.thread_bounds, AIMD style: while
+            all slots are busy, add one download as long as throughput
+            keeps up, cut them by a quarter when throughput falls or too
+            many transfers fail. """
+        now = time.time()
+        received = self.bytes_received + \
+                   sum([watch.received for watch in self.transfers.keys()])
+        if not self.tune_state:
+            self.tune_state = (now, received, self.transfers_done, self.transfers_failed, None)
+            return
+        (last, last_received, last_done, last_failed, last_throughput) = self.tune_state
+        throughput = (received - last_received) / max(now - last, 0.001)
+        done = self.transfers_done - last_done
+        failed = self.transfers_failed - last_failed
+        self.tune_state = (now, received, self.transfers_done, self.transfers_failed, throughput)
+        (low, high) = self.thread_bounds
+        threads = self.threads
+        busy = self.pending_downloads and self.active_downloads >= self.threads
+        if done and float(failed) / done > TUNE_MAX_ERRORS:
+            threads = min(threads - 1, int(threads * TUNE_DECREASE))
+            reason = _("%s of %s transfers failed" % (failed, done))
+        elif not busy:
+            return
+        elif last_throughput and throughput < last_throughput * (1 - TUNE_TOLERANCE):
+            threads = min(threads - 1, int(threads * TUNE_DECREASE))
+            reason = _("throughput fell from %.0f to %.0f KB/s" % \
+                       (last_throughput / 1024, throughput / 1024))
         else:
-            self.finish()
-        self.log.debug(_("Checkpoint exit."))
+            threads += 1
+            reason = _("throughput is %.0f KB/s" % (throughput / 1024))
+        threads = max(low, min(high, threads))
+        if threads == self.threads: return
+        self.log.info(_("Download threads %s -> %s, %s." % (self.threads, threads, reason)))
+        self.threads = threads
+        self.schedule()
+
+    def abort_transfers(self, file, reason):
+        """ Abort the transfers to file, because of reason. """
+        for watch in self.transfers.keys():
+            if watch.file == file and not watch.reason: watch.abort(reason)
+
+    def count_abort(self, reason):
+        """ Count a transfer aborted because of reason. """
+        self.aborts[reason] = self.aborts.get(reason, 0) + 1
+
+    def check_transfers(self):
+        """ Abort transfers that have stalled, or that have been slower
+            than min_speed for min_speed_time. Then see if any should be
+            raced by a second copy. """
+        self.hedge_stragglers()
+        now = time.time()
+        for watch in self.transfers.keys():
+            if watch.reason: continue
+            if now - watch.last_data > self.timeout:
+                self.log.debug(_("No data from %s for %s seconds." % (watch.url, self.timeout)))
+                watch.abort(_("idle timeout"))
+            elif now - watch.window_start >= self.min_speed_time:
+                if watch.throttled:
+                    # We held it back ourselves, judge it on the next window.
+                    watch.throttled = False
+                    watch.window_start = now
+                    watch.window_received = watch.received
+                    continue
+                speed = (watch.received - watch.window_received) / (now - watch.window_start)
+                if speed < self.min_speed * 1024:
+                    self.log.debug(_("%s is too slow: %.1f KB/s" % (watch.url, speed / 1024)))
+                    watch.abort(_("too slow"))
+                else:
+                    watch.window_start = now
+                    watch.window_received = watch.received
 
     def stop(self):
         """ Stop the reactor. """
+        self.started = False
+        if self.reporter and self.reporter.running: self.reporter.stop()
+        if self.watchdog and self.watchdog.running: self.watchdog.stop()
+        if self.tuner and self.tuner.running: self.tuner.stop()
+        if self.aborts: self.log.info(self.abort_stats())
+        if self.hedges_started: self.log.info(self.hedge_stats())
+        self.log.info(_("Mirrors:\n%s" % self.mirror_stats))
+        if self.pool:
+            self.log.info(self.connection_stats())
+            self.pool.closeCachedConnections()
+        self.stuffer.stop()
+        self.hasher.stop()
+        close_hash_cache(self.log)
+        if self.scan_index: self.scan_index.close()
         try:
             self.reactor.stop()
         except RuntimeError, e:
             self.log.critical(_("Reactor reported: %s" % e))
         self.base.done()
 
-    def finish(self):
-        """ Check to see if we are done. If not, checkpoint().
-            If so, attempt to stop() the reactor. It is possible
-            there are still pending items, and if so checkpoint(). """
+    def index_scan_root(self, root):
+        """ Bring the scan index up to date for root, once per run, no matter
+            how many images scan it. Return a Deferred firing when done. """
+        state = self.indexed_roots.get(root)
+        if state is True: return defer.succeed(None)
+        d = defer.Deferred()
+        if state is not None:
+            state.append(d)
+            return d
+        self.indexed_roots[root] = [d]
+        update = self.hasher.run(self.scan_index.update, root)
+        update.addErrback(self.index_scan_root_failure, root)
+        update.addCallback(self.index_scan_root_done, root)
+        return d
+
+    def index_scan_root_failure(self, failure, root):
+        """ Errback entry point for when root could not be indexed. """
+        self.log.error(_("Failed to index %s: %s" % (root, failure.getErrorMessage())))
+
+    def index_scan_root_done(self, ign, root):
+        """ Callback entry point for when root has been indexed. """
+        waiters = self.indexed_roots[root]
+        self.indexed_roots[root] = True
+        for waiter in waiters: waiter.callback(None)
+
+    def index_hash_file(self, root, path):
+        """ Sum root/path into the scan index. A file being summed for one
+            image is not summed again for another. Return a Deferred firing
+            with the sum or None. """
+        key = (root, path)
+        d = defer.Deferred()
+        if self.indexed_hashing.has_key(key):
+            self.indexed_hashing[key].append(d)
+            return d
+        self.indexed_hashing[key] = [d]
+        hashing = self.hasher.run(self.scan_index.hash_file, root, path)
+        hashing.addBoth(self.index_hash_file_done, key)
+        return d
+
+    def index_hash_file_done(self, result, key):
+        """ Callback entry point for when a file has been summed for the index. """
+        waiters = self.indexed_hashing.pop(key)
+        for waiter in waiters: waiter.callback(result)
+
+    def selected_images(self):
+        """ Return all selected JigdoImage()s. """
+        images = []
+        for jigdo_file in self.base.jigdo_files.values():
+            # Not parsed yet.
+            if not jigdo_file.jigdo_data: continue
+            for image in jigdo_file.jigdo_data.images.values():
+                if image.selected: images.append(image)
+        return images
+
+    def finish(self, ign=None):
+        """ Check to see if we are done. If downloads are still pending or
+            running, schedule() will call us again when they are done.
+            Otherwise wait for the workers and attempt to stop() the reactor. """
+        self.finish_waiting = False
         self.log.debug(_("finish() has been called, checking for pending actions..."))
-        if self.pending_downloads:
-            self.log.debug(_("Still pending items, checkpointing..."))
-            self.checkpoint(None)
-        else:
-            # Stuff any remaining bits we have downloaded.
-            images_status = []
-            for jigdo_file in self.base.jigdo_files.values():
-                for image in jigdo_file.jigdo_data.images.values():
-                    if image.selected: images_status.append( image.finish() )
-            if not all(images_status):
-                # FIXME: Don't stop(), we are not done.
-                # We should also tell the user what's failed/missing.
-                self.log.critical("We're not done, fail!!!")
-            self.stop()
-
-    def get_pending_downloads(self, get_factor=0):
-        """ Attempt to safely get a list of pending downloads. """
-        r = []
-        if get_factor:
-            while self.pending_downloads and \
-              not (len(r) >= (self.base.settings.download_threads * get_factor)):
-                r.append(self.pending_downloads.pop(0))
-        else:
-            while self.pending_downloads:
-                r.append(self.pending_downloads.pop(0))
-        return r
+        if self.pending_downloads or self.active_downloads or self.delayed_downloads:
+            self.log.debug(_("Still pending items, scheduling..."))
+            self.schedule()
+            return
+        if self.hasher.busy():
+            # Checking existing data may still find things to download.
+            self.log.debug(_("Waiting for file checks to finish..."))
+            self.finish_waiting = True
+            self.hasher.wait_idle().addCallback(self.finish)
+            return
+        # Stuff any remaining bits we have downloaded.
+        images = self.selected_images()
+        for image in images: image.stuff_data()
+        if self.stuffer.busy():
+            self.log.debug(_("Waiting for data to be stuffed into images..."))
+            self.finish_waiting = True
+            self.stuffer.wait_idle().addCallback(self.finish)
+            return
+        if self.pending_downloads or self.delayed_downloads:
+            # Data that failed to stuff is being fetched again.
+            self.schedule()
+            return
+        images_status = [image.finish() for image in images]
+        if not all(images_status):
+            # FIXME: Don't stop(), we are not done.
+            # We should also tell the user what's failed/missing.
+            self.log.critical("We're not done, fail!!!")
+        self.stop()
 
-    def download_object(self, jigdo_object):
+    def download_object(self, jigdo_object, resume=False, url=None, conditional=False):
         """ Try to download the data from jigdo_object.source()
-            to jigdo_object.target() and call
-            jigdo_object.download_callback_$status() when done. """
+            (or url, if given) to jigdo_object.target() and call
+            jigdo_object.download_callback_$status() when done.
+            On success, the callback is given the jigdo md5 sum
+            of the downloaded data. If resume is True, data already
+            in the target is kept and only the rest is fetched.
+            If conditional is True, see download_file(). """
         target_location = jigdo_object.target()
         check_directory(self.log, os.path.dirname(target_location))
-        d = downloadPage( jigdo_object.source(),
-                          target_location,
-                          agent = PYJIGDO_USER_AGENT )
-        #                  timeout = self.timeout )
+        transfer = None
+        if self.hedge_after and hasattr(jigdo_object, "hedge_source"):
+            # Objects that can give another source may be raced.
+            transfer = HedgedTransfer(jigdo_object, target_location, jigdo_object.slice_sum)
+        d = self.download_file( url or jigdo_object.source(),
+                                target_location,
+                                resume,
+                                conditional,
+                                transfer )
+        if transfer:
+            self.hedgeable[transfer] = True
+            d.addBoth(self.hedged_result, transfer, target_location)
+            d = transfer.deferred
         d.addCallback(jigdo_object.download_callback_success)
         d.addErrback(jigdo_object.download_callback_failure)
         return d
 
-    def fetch_data(self, url, call_success, call_failure, repo_id):
+    def hedge_stragglers(self):
+        """ When nothing is waiting to be queued and there are free slots,
+            race the slowest downloads running for more than hedge_after
+            seconds with a second copy from another source. """
+        if not self.hedge_after or not self.started: return
+        if self.pending_downloads or self.delayed_downloads: return
+        free = self.threads - self.active_downloads - self.hedges_running
+        if free <= 0: return
+        now = time.time()
+        candidates = []
+        for transfer in self.hedgeable.keys():
+            if transfer.hedged or now - transfer.started < self.hedge_after: continue
+            candidates.append((self.remaining_time(transfer), transfer))
+        candidates.sort()
+        candidates.reverse()
+        for (remaining, transfer) in candidates[:free]:
+            transfer.hedged = True
+            url = transfer.jigdo_object.hedge_source()
+            if not url: continue
+            limits = self.download_limits(url, getattr(transfer.jigdo_object, "repo", None))
+            if not self.take_limits(limits):
+                self.log.debug(_("Not racing %s, %s is busy." % (transfer.file, url)))
+                continue
+            self.log.info(_("Racing %s with a second copy from %s" % (transfer.file, url)))
+            transfer.running += 1
+            self.hedges_running += 1
+            self.hedges_started += 1
+            d = self.download_file(url, transfer.hedge_file)
+            d.addBoth(self.hedged_result, transfer, transfer.hedge_file)
+            d.addBoth(self.hedge_done, limits)
+
+    def remaining_time(self, transfer):
+        """ Return (stalled, estimated seconds) left for transfer's first copy.
+            The estimate is None when there is no rate to go by: the copy
+            has stalled, or has not sent its request yet. """
+        now = time.time()
+        for watch in self.transfers.keys():
+            if watch.file != transfer.file: continue
+            if not watch.received: return (True, None)
+            rate = watch.received / max(now - watch.started, 0.001)
+            return (False, max(transfer.jigdo_object.size - watch.received, 0) / rate)
+        return (False, None)
+
+    def hedge_done(self, ign, limits):
+        """ A second copy is done, its slot is free. """
+        self.hedges_running -= 1
+        self.release_limits(limits)
+        self.schedule()
+
+    def hedged_result(self, result, transfer, file):
+        """ Callback entry point for when one copy of transfer, to file,
+            is done. The first with the expected sum wins and the other
+            copy is aborted, if all copies fail, the last failure is
+            passed on. """
+        transfer.running -= 1
+        if transfer.done:
+            # The other copy won.
+            if file == transfer.hedge_file: remove_file(self.log, file)
+            return None
+        good = not isinstance(result, Failure) and result == transfer.expected
+        if not good and transfer.running:
+            # Wait for the other copy.
+            if file == transfer.hedge_file: remove_file(self.log, file)
+            return None
+        transfer.done = True
+        del self.hedgeable[transfer]
+        if transfer.running:
+            if file == transfer.hedge_file:
+                (stalled, remaining) = self.remaining_time(transfer)
+                if remaining is not None:
+                    self.hedge_saved += remaining
+                    self.hedges_estimated += 1
+                self.hedges_won += 1
+                self.abort_transfers(transfer.file, _("raced"))
+            else:
+                self.abort_transfers(transfer.hedge_file, _("raced"))
+        if good and file == transfer.hedge_file:
+            os.rename(file, transfer.file)
+        if isinstance(result, Failure):
+            transfer.deferred.errback(result)
+        else:
+            transfer.deferred.callback(result)
+        return None
+
+    def can_segment(self):
+        """ Return True if we can fetch byte ranges from several mirrors at once. """
+        return bool(self.agent)
+
+    def download_segmented(self, jigdo_object, urls):
+        """ Like download_object(), but fetch jigdo_object.target() in
+            jigdo_object.size bytes, split in byte ranges fetched from each
+            of urls at the same time. The ranges are written in place and
+            the whole file is summed once they are all there.
+            If a server does not honour the ranges, fall back to fetching
+            everything from it. """
+        target_location = jigdo_object.target()
+        check_directory(self.log, os.path.dirname(target_location))
+        size = jigdo_object.size
+        self.log.debug(_("Fetching %s in %s segments" % (target_location, len(urls))))
+        f = open(target_location, "wb")
+        f.truncate(size)
+        f.close()
+        segment_length = size / len(urls)
+        segments = []
+        for (i, url) in enumerate(urls):
+            start = i * segment_length
+            end = start + segment_length - 1
+            if i == len(urls) - 1: end = size - 1
+            segments.append(jigdoSegment(url, target_location, start, end))
+        d = defer.DeferredList([self.download_segment(segment) for segment in segments],
+                               fireOnOneErrback=True, consumeErrors=True)
+        d.addCallback(self.segments_done, target_location)
+        d.addErrback(self.segments_failed, segments, target_location)
+        d.addCallback(jigdo_object.download_callback_success)
+        d.addErrback(jigdo_object.download_callback_failure)
+        return d
+
+    def download_segment(self, segment):
+        """ Request the byte range of segment. """
+        self.requests_made += 1
+        mirror = self.mirror_stats.get(segment.url)
+        started = mirror.start()
+        watch = self.watch_transfer(segment.url)
+        segment.watch = watch
+        headers = Headers({"User-Agent": [PYJIGDO_USER_AGENT],
+                           "Range": ["bytes=%d-%d" % (segment.start, segment.end)]})
+        d = self.agent.request("GET", segment.url, headers)
+        watch.aborter = d.cancel
+        d.addCallback(self.segment_response, segment, mirror, started)
+        d.addBoth(self.unwatch_transfer, watch)
+        d.addCallbacks(self.segment_measured, self.download_measure_failure,
+                       callbackArgs = (segment, mirror, started),
+                       errbackArgs = (mirror, started))
+        return d
+
+    def segment_measured(self, result, segment, mirror, started):
+        """ Callback entry point for when a segment is done, note how it went.
+            A segment we aborted because a sibling failed says nothing
+            about its mirror. """
+        if segment.aborted:
+            mirror.skipped(started)
+        else:
+            mirror.done(started, segment.received)
+        return result
+
+    def segment_response(self, response, segment, mirror, started):
+        """ Callback entry point for when the response to a segment starts. """
+        mirror.first_byte(started)
+        content_range = response.headers.getRawHeaders("Content-Range", [""])[0]
+        if response.code == 206 and \
+           content_range.startswith("bytes %d-%d/" % (segment.start, segment.end)):
+            self.deliver_body(response, segment, segment.watch)
+            return segment.finished
+        # Drop the connection rather than read what we did not ask for.
+        segment.aborted = True
+        response.deliverBody(segment)
+        if response.code in (200, 206): raise RangeNotHonoured(segment.url)
+        raise error.Error(str(response.code), response.phrase)
+
+    def segments_done(self, results, file):
+        """ Callback entry point for when all segments are in file.
+            Sum it in the hashing pool. """
+        return self.hasher.run(file_hash, self.log, file)
+
+    def segments_failed(self, failure, segments, file):
+        """ Errback entry point for when a segment failed. Stop the others,
+            and if it was because ranges are not honoured, fetch the whole
+            file in one go. """
+        failure.trap(defer.FirstError)
+        failure = failure.value.subFailure
+        for segment in segments: segment.abort()
+        remove_file(self.log, file)
+        if not failure.check(RangeNotHonoured): return failure
+        self.log.info(_("%s, fetching %s in one go." % (failure.getErrorMessage(), file)))
+        return self.download_file(failure.value.url, file)
+
+    def download_file(self, url, file, resume=False, conditional=False, transfer=None):
+        """ Download url to file. Return a Deferred firing with the
+            jigdo md5 sum of the data. If resume is True and file has
+            data, its sum is taken in the hashing pool and only the
+            rest of the data is requested, unless the HedgedTransfer()
+            this is the first copy of is already done by then.
+            If conditional is True, the validators saved with file are
+            sent, and if the server says file has not changed, it is kept
+            and the Deferred fires with None. """
+        if resume and os.path.isfile(file) and os.path.getsize(file):
+            d = self.hasher.run(partial_hash, self.log, file)
+            d.addErrback(self.partial_hash_failure, file)
+            if transfer: d.addCallback(self.check_raced, url, transfer)
+            d.addCallback(self.download_request, url, file, conditional)
+            return d
+        return self.download_request(None, url, file, conditional)
+
+    def check_raced(self, seed, url, transfer):
+        """ Callback entry point for when the data to resume from has
+            been summed. If a second copy has won the race meanwhile,
+            the file is already complete, so do not request any more. """
+        if not transfer.done: return seed
+        self.count_abort(_("raced"))
+        raise TransferAborted(url, _("raced"))
+
+    def partial_hash_failure(self, failure, file):
+        """ Errback entry point for when the data in file could not be
+            summed, download all of it. """
+        self.log.warning(_("Could not resume %s: %s" % (file, failure.getErrorMessage())))
+        return None
+
+    def download_request(self, seed, url, file, conditional=False):
+        """ Request url, seed is (md5, size) of the data already in file
+            to resume from, or None. If conditional is True, only ask
+            for file if it has changed, see download_file(). """
+        self.requests_made += 1
+        if seed:
+            self.log.debug(_("Resuming %s from byte %s" % (url, seed[1])))
+        request_headers = {}
+        validators = {}
+        if conditional:
+            validators = read_validators(self.log, file, url)
+            for (name, value) in validators.items():
+                if CONDITIONAL_HEADERS.has_key(name):
+                    request_headers[CONDITIONAL_HEADERS[name]] = value
+            # Until this request is done, file may not be what they describe.
+            if validators: remove_file(self.log, "%s.validators" % file)
+        mirror = self.mirror_stats.get(url)
+        started = mirror.start()
+        watch = self.watch_transfer(url, file)
+        if not self.agent:
+            factory = self.download_page( url, file,
+                                          supportPartial = bool(seed),
+                                          seed_md5 = seed and seed[0],
+                                          mirror = (mirror, started),
+                                          watch = watch,
+                                          headers = request_headers )
+            watch.aborter = factory.jigdo_connector.disconnect
+            d = factory.deferred
+            if conditional: d.addCallback(self.download_validators, factory, url, file)
+            d.addCallback(self.download_digest, factory)
+        else:
+            headers = Headers({"User-Agent": [PYJIGDO_USER_AGENT]})
+            if seed: headers.addRawHeader("Range", "bytes=%d-" % seed[1])
+            for (name, value) in request_headers.items(): headers.addRawHeader(name, value)
+            d = self.agent.request("GET", url, headers)
+            watch.aborter = d.cancel
+            d.addCallback(self.download_response, url, file, seed, (mirror, started), watch,
+                          conditional)
+        # A 304 or a 416 on complete data are fine, not failed transfers.
+        if request_headers: d.addErrback(self.download_not_modified, url, file, validators, watch)
+        if seed: d.addErrback(self.download_range_failure, seed, watch)
+        d.addBoth(self.unwatch_transfer, watch)
+        d.addCallbacks(self.download_measured, self.download_measure_failure,
+                       callbackArgs = (mirror, started, file, seed, watch),
+                       errbackArgs = (mirror, started))
+        return d
+
+    def download_measured(self, result, mirror, started, file, seed, watch):
+        """ Callback entry point for when a download is done, note how it went. """
+        if watch.unmeasured:
+            mirror.skipped(started)
+            return result
+        try:
+            size = os.path.getsize(file)
+        except OSError:
+            size = 0
+        if seed: size -= seed[1]
+        mirror.done(started, size)
+        return result
+
+    def download_measure_failure(self, failure, mirror, started):
+        """ Errback entry point for when a download failed, note it.
+            Losing a race says nothing about the mirror. """
+        if failure.check(TransferAborted) and failure.value.reason == _("raced"):
+            mirror.skipped(started)
+        else:
+            mirror.failed(started)
+        return failure
+
+    def download_not_modified(self, failure, url, file, validators, watch):
+        """ Errback entry point for conditional downloads. A 304 means
+            file is current, so its validators still hold and there is
+            no sum to give. """
+        failure.trap(error.Error)
+        if failure.value.status != "304": return failure
+        self.log.debug(_("%s has not changed." % url))
+        watch.unmeasured = True
+        save_validators(self.log, file, url, validators)
+        return None
+
+    def download_validators(self, result, factory, url, file):
+        """ Callback entry point for when a download by factory is done,
+            save its validators for the next conditional request. """
+        validators = {}
+        for name in CONDITIONAL_HEADERS.keys():
+            values = factory.response_headers.get(name.lower())
+            if values: validators[name] = values[0]
+        save_validators(self.log, file, url, validators)
+        return result
+
+    def save_response_validators(self, result, response, url, file):
+        """ Callback entry point for when the body of response has been
+            written to file, save its validators for the next
+            conditional request. """
+        validators = {}
+        for name in CONDITIONAL_HEADERS.keys():
+            values = response.headers.getRawHeaders(name)
+            if values: validators[name] = values[0]
+        save_validators(self.log, file, url, validators)
+        return result
+
+    def download_range_failure(self, failure, seed, watch):
+        """ Errback entry point for resumed downloads. A 416 means there
+            is nothing after the data we have, it may be complete already,
+            so give its sum to be verified. """
+        failure.trap(error.Error)
+        if failure.value.status != "416": return failure
+        watch.unmeasured = True
+        return jigdo_md5(seed[0].digest())
+
+    def download_response(self, response, url, file, seed=None, mirror=None, watch=None,
+                          conditional=False):
+        """ Callback entry point for when the response to download_request()
+            starts. Write the body to file, unless the request failed.
+            A 206 carries on from the data we have, a 200 means the server
+            ignored our range and sends everything. For conditional
+            requests, the validators of a 200 are saved with file. """
+        if mirror: mirror[0].first_byte(mirror[1])
+        finished = defer.Deferred()
+        if response.code == 206 and seed:
+            content_range = response.headers.getRawHeaders("Content-Range", [""])[0]
+            if content_range.startswith("bytes %d-" % seed[1]):
+                self.deliver_body(response, jigdoBodyWriter(open(file, "ab"), finished, seed[0], watch), watch)
+                return finished
+            self.log.warning(_("Unexpected range %s for %s, starting over." % (content_range, url)))
+            remove_file(self.log, file)
+            return self.response_error(response, url, watch)
+        if response.code != 200: return self.response_error(response, url, watch)
+        if conditional: finished.addCallback(self.save_response_validators, response, url, file)
+        self.deliver_body(response, jigdoBodyWriter(open(file, "wb"), finished, None, watch), watch)
+        return finished
+
+    def deliver_body(self, response, protocol, watch=None):
+        """ Have the body of response delivered to protocol. Aborting
+            the transfer now means dropping the connection. """
+        response.deliverBody(protocol)
+        if watch: watch.aborter = protocol.transport.stopProducing
+
+    def response_error(self, response, url, watch=None):
+        """ Read and drop the body of a failed response, so the connection
+            can be reused, then fail with the status. """
+        finished = defer.Deferred()
+        self.deliver_body(response, jigdoBodyReader(finished, watch), watch)
+        finished.addCallback(self.raise_response_error, response, url)
+        return finished
+
+    def raise_response_error(self, body, response, url):
+        """ Fail with the status of response. """
+        raise error.Error(str(response.code), response.phrase, body)
+
+    def fetch_page(self, url):
+        """ Download url. Return a Deferred firing with the data. """
+        self.requests_made += 1
+        if not self.agent:
+            return getPage( url,
+                            agent = PYJIGDO_USER_AGENT,
+                            timeout = self.timeout )
+        watch = self.watch_transfer(url)
+        d = self.agent.request("GET", url, Headers({"User-Agent": [PYJIGDO_USER_AGENT]}))
+        watch.aborter = d.cancel
+        d.addCallback(self.fetch_response, url, watch)
+        d.addBoth(self.unwatch_transfer, watch)
+        return d
+
+    def fetch_response(self, response, url, watch=None):
+        """ Callback entry point for when the response to fetch_page() starts. """
+        if response.code != 200: return self.response_error(response, url, watch)
+        finished = defer.Deferred()
+        self.deliver_body(response, jigdoBodyReader(finished, watch), watch)
+        return finished
+
+    def download_page(self, url, file, **kwargs):
+        """ Like twisted's downloadPage(), but using jigdoHTTPDownloader.
+            Return the factory, factory.deferred fires when done. """
+        factory = jigdoHTTPDownloader(url, file, agent = PYJIGDO_USER_AGENT, **kwargs)
+        url_data = urlparse.urlsplit(url)
+        host = url_data.hostname
+        if url_data.scheme == 'https':
+            from twisted.internet import ssl
+            factory.jigdo_connector = self.reactor.connectSSL( host, url_data.port or 443,
+                                                               factory, ssl.ClientContextFactory(),
+                                                               timeout = self.timeout )
+        else:
+            factory.jigdo_connector = self.reactor.connectTCP( host, url_data.port or 80, factory,
+                                                               timeout = self.timeout )
+        return factory
+
+    def read_data(self, ign, location):
+        """ Return the data downloaded to location. """
+        f = open(location, "rb")
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def download_digest(self, ign, factory):
+        """ Return the sum taken by factory while downloading. """
+        return factory.digest()
+
+    def fetch_data(self, url, call_success, call_failure, repo_id, location=None):
         """ Try to download the data from given url.
             Callback to call_success() or call_failure()
-            based on task status. """
-        d = getPage( url,
-                     agent = PYJIGDO_USER_AGENT )
-        #            timeout = self.timeout )
+            based on task status.
+            If location is given, the data is kept there and later
+            fetches only download it again if it has changed. """
+        if location:
+            check_directory(self.log, os.path.dirname(location))
+            d = self.download_file(url, location, conditional=True)
+            d.addCallback(self.read_data, location)
+        else:
+            d = self.fetch_page(url)
         d.addCallback(call_success, repo_id=repo_id)
         d.addErrback(call_failure, repo_id=repo_id)
         return d
-
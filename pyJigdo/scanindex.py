@@ -0,0 +1,156 @@
+#
+# Copyright 2007-2009 Fedora Unity Project (http://fedoraunity.org)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+A persistent index of the files under the --scan-dir directories.
+Each run only stats the tree for changes, and files are only summed
+when they might be needed, so large local mirrors are cheap to rescan.
+"""
+
+import os, stat, threading
+
+try:
+    # Py2.5
+    import sqlite3
+except ImportError:
+    # Py2.4
+    from pysqlite2 import dbapi2 as sqlite3
+
+from pyJigdo.util import file_hash
+from pyJigdo.translate import _, N_
+
+# Commit to disk after this many new sums.
+COMMIT_INTERVAL = 100
+
+def mtime_ns(st):
+    """ Return the mtime of the given os.stat() result in nanoseconds. """
+    return int(st.st_mtime * 1000000000)
+
+class ScanIndex:
+    """ An sqlite backed index of (path, size, mtime, md5) per scan root.
+        The md5 is only filled in once a file has been summed, and is
+        cleared when the file changes.
+        This is used from more than one thread, so all access is locked. """
+    def __init__(self, log, location):
+        self.log = log
+        self.location = location
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(location, check_same_thread=False)
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        " root TEXT, path TEXT, size INTEGER, mtime_ns INTEGER,"
+                        " md5 TEXT,"
+                        " PRIMARY KEY (root, path))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_md5 ON files (root, md5)")
+
+    def update(self, root):
+        """ Walk root and bring its entries up to date. New or changed files
+            are added without a sum, removed files are dropped. """
+        self.lock.acquire()
+        try:
+            known = {}
+            for (path, size, mtime) in self.db.execute("SELECT path, size, mtime_ns"
+                                                       " FROM files WHERE root = ?",
+                                                       (root,)):
+                known[path] = (size, mtime)
+        finally:
+            self.lock.release()
+        changed = []
+        for (path, directories, files) in os.walk(root):
+            for name in files:
+                full_path = os.path.join(path, name)
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode): continue
+                relative_path = full_path[len(root):].lstrip('/')
+                key = (st.st_size, mtime_ns(st))
+                if known.pop(relative_path, None) != key:
+                    changed.append((root, relative_path) + key)
+        self.lock.acquire()
+        try:
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, NULL)",
+                                changed)
+            self.db.executemany("DELETE FROM files WHERE root = ? AND path = ?",
+                                [(root, path) for path in known.keys()])
+            self.commit()
+        finally:
+            self.lock.release()
+        self.log.info(_("Scan index for %s: %s new or changed, %s removed." % \
+                        (root, len(changed), len(known))))
+
+    def lookup(self, root, md5):
+        """ Return the path under root of a file known to have md5 as sum, or None. """
+        self.lock.acquire()
+        try:
+            row = self.db.execute("SELECT path FROM files WHERE root = ? AND md5 = ?",
+                                  (root, md5)).fetchone()
+        finally:
+            self.lock.release()
+        if row: return os.path.join(root, row[0])
+        return None
+
+    def unhashed(self, root):
+        """ Return a dictionary {path: size} of the files under root
+            that have not been summed yet. """
+        self.lock.acquire()
+        try:
+            rows = self.db.execute("SELECT path, size FROM files"
+                                   " WHERE root = ? AND md5 IS NULL", (root,)).fetchall()
+        finally:
+            self.lock.release()
+        unhashed = {}
+        for (path, size) in rows: unhashed[path] = size
+        return unhashed
+
+    def hash_file(self, root, path):
+        """ Sum root/path and remember it, return the sum or None.
+            This blocks, run it in a hashing pool. """
+        full_path = os.path.join(root, path)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            return None
+        md5 = file_hash(self.log, full_path)
+        if not md5: return None
+        self.lock.acquire()
+        try:
+            # Only keep the sum if the file is still the one we indexed.
+            self.db.execute("UPDATE files SET md5 = ? WHERE root = ? AND path = ?"
+                            " AND size = ? AND mtime_ns = ?",
+                            (md5, root, path, st.st_size, mtime_ns(st)))
+            self.uncommitted += 1
+            if self.uncommitted >= COMMIT_INTERVAL: self.commit()
+        finally:
+            self.lock.release()
+        return md5
+
+    def commit(self):
+        """ Write pending changes to disk. """
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        """ Write everything out and close the index. """
+        self.lock.acquire()
+        try:
+            self.commit()
+            self.db.close()
+        finally:
+            self.lock.release()
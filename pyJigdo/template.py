@@ -0,0 +1,407 @@
+#
+# Copyright 2007-2009 Fedora Unity Project (http://fedoraunity.org)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Native support for the jigdo .template format, so we don't have to shell
+out to jigdo-file to learn what an image is made of or to put it together.
+
+A template starts with a text header ending in an empty line, followed by
+the compressed data that is not part of any file:
+    "DATA" or "BZIP", 6 byte part length, 6 byte data length, data
+and ends (as does a jigdo-file .tmp image) with a DESC table:
+    "DESC", 6 byte length, entries..., 6 byte length
+All numbers are little-endian. Each entry starts with a one byte type.
+"""
+
+import os, zlib, bz2
+
+from pyJigdo.util import jigdo_md5, check_hash, K, M
+
+from pyJigdo.translate import _, N_
+
+# DESC entry types, these must match jigdo-file.
+DESC_OBSOLETE_IMAGE_INFO = 1
+DESC_UNMATCHED_DATA = 2
+DESC_OBSOLETE_MATCHED_FILE = 3
+DESC_OBSOLETE_WRITTEN_FILE = 4
+DESC_IMAGE_INFO = 5
+DESC_MATCHED_FILE = 6
+DESC_WRITTEN_FILE = 7
+
+# Size of each entry, without the leading type byte.
+DESC_ENTRY_SIZES = { DESC_OBSOLETE_IMAGE_INFO: 6+16,
+                     DESC_UNMATCHED_DATA: 6,
+                     DESC_OBSOLETE_MATCHED_FILE: 6+16,
+                     DESC_OBSOLETE_WRITTEN_FILE: 6+16,
+                     DESC_IMAGE_INFO: 6+16+4,
+                     DESC_MATCHED_FILE: 6+8+16,
+                     DESC_WRITTEN_FILE: 6+8+16 }
+
+DESC_READ_SIZE = 64*K
+COPY_SIZE = 1*M
+
+class TemplateError(Exception):
+    """ The template could not be understood. """
+    pass
+
+def read_number(data, pos=0, length=6):
+    """ Return the little-endian number of length bytes at data[pos:]. """
+    number = 0
+    for i in xrange(pos + length - 1, pos - 1, -1):
+        number = (number << 8) | ord(data[i])
+    return number
+
+class TemplateImageInfo:
+    """ The image-info entry: the size and md5 of the final image. """
+    def __init__(self, size, md5, rsync_block_length=None):
+        self.size = size
+        self.md5 = md5
+        self.rsync_block_length = rsync_block_length
+
+    def __str__(self):
+        return "image-info %s %s %s" % (self.size, self.md5, self.rsync_block_length)
+
+class TemplateUnmatchedData:
+    """ Image data that is stored in the template itself. """
+    def __init__(self, offset, size):
+        self.offset = offset
+        self.size = size
+
+    def __str__(self):
+        return "in-template %s %s" % (self.offset, self.size)
+
+class TemplateMatchedFile:
+    """ A file that makes up part of the image.
+        written is True if the data is already in a .tmp image. """
+    def __init__(self, offset, size, md5, rsync=None, written=False):
+        self.offset = offset
+        self.size = size
+        self.md5 = md5
+        self.rsync = rsync
+        self.written = written
+
+    def __str__(self):
+        if self.written: state = "have-file"
+        else: state = "need-file"
+        return "%s %s %s %s" % (state, self.offset, self.size, self.md5)
+
+class JigdoTemplateReader:
+    """ Read the DESC table of a jigdo template or .tmp image,
+        yielding typed records. """
+    def __init__(self, log, template_file):
+        self.log = log
+        self.template_file = template_file
+
+    def find_desc(self, f):
+        """ Return (offset, length) of the DESC table in open file f. """
+        f.seek(0, 2)
+        file_size = f.tell()
+        if file_size < 16:
+            raise TemplateError(_("%s is too small to be a template." % self.template_file))
+        f.seek(file_size - 6)
+        desc_length = read_number(f.read(6))
+        desc_offset = file_size - desc_length
+        if desc_length < 16 or desc_offset < 0:
+            raise TemplateError(_("%s has an invalid DESC length." % self.template_file))
+        f.seek(desc_offset)
+        header = f.read(10)
+        if header[:4] != "DESC" or read_number(header, 4) != desc_length:
+            raise TemplateError(_("%s has no DESC table." % self.template_file))
+        return (desc_offset, desc_length)
+
+    def data_chunks(self):
+        """ Stream the uncompressed template data, part by part. This is the
+            data for all of the TemplateUnmatchedData entries, in order. """
+        f = open(self.template_file, "rb")
+        try:
+            # Skip the text header, it ends with an empty line.
+            while True:
+                line = f.readline()
+                if not line:
+                    raise TemplateError(_("%s has no template header." % self.template_file))
+                if line in ("\r\n", "\n"): break
+            while True:
+                header = f.read(16)
+                if header[:4] == "DESC": break
+                if len(header) < 16 or header[:4] not in ("DATA", "BZIP"):
+                    raise TemplateError(_("%s has an invalid data part." % self.template_file))
+                part_length = read_number(header, 4)
+                data_length = read_number(header, 10)
+                compressed = f.read(part_length - 16)
+                if header[:4] == "DATA":
+                    decompressor = zlib.decompressobj()
+                    data = decompressor.decompress(compressed) + decompressor.flush()
+                else:
+                    data = bz2.decompress(compressed)
+                if len(data) != data_length:
+                    raise TemplateError(_("%s has a corrupt data part." % self.template_file))
+                yield data
+        finally:
+            f.close()
+
+    def entries(self):
+        """ Stream the DESC entries of the template. Offsets are calculated
+            in the final image. The image-info entry is the last one. """
+        f = open(self.template_file, "rb")
+        try:
+            (desc_offset, desc_length) = self.find_desc(f)
+            # Everything between the header and the trailing length field.
+            remaining = desc_length - 16
+            offset = 0
+            pending = ""
+            while True:
+                chunk = ""
+                if remaining > 0:
+                    chunk = f.read(min(DESC_READ_SIZE, remaining))
+                    if not chunk:
+                        raise TemplateError(_("%s has a truncated DESC table." % self.template_file))
+                    remaining -= len(chunk)
+                buf = pending + chunk
+                pos = 0
+                while pos < len(buf):
+                    entry_type = ord(buf[pos])
+                    try:
+                        entry_size = DESC_ENTRY_SIZES[entry_type]
+                    except KeyError:
+                        raise TemplateError(_("%s has an unknown DESC entry type %s." % \
+                                             (self.template_file, entry_type)))
+                    if pos + 1 + entry_size > len(buf): break
+                    record = self.make_record(entry_type, buf, pos + 1, offset)
+                    if not isinstance(record, TemplateImageInfo):
+                        offset += record.size
+                    yield record
+                    pos += 1 + entry_size
+                pending = buf[pos:]
+                if remaining <= 0:
+                    if pending:
+                        raise TemplateError(_("%s has a truncated DESC table." % self.template_file))
+                    break
+        finally:
+            f.close()
+
+    def make_record(self, entry_type, buf, pos, offset):
+        """ Create the record for the entry of entry_type at buf[pos:]. """
+        size = read_number(buf, pos)
+        if entry_type == DESC_UNMATCHED_DATA:
+            return TemplateUnmatchedData(offset, size)
+        elif entry_type in (DESC_MATCHED_FILE, DESC_WRITTEN_FILE):
+            return TemplateMatchedFile( offset, size,
+                                        jigdo_md5(buf[pos+14:pos+30]),
+                                        rsync = read_number(buf, pos+6, 8),
+                                        written = (entry_type == DESC_WRITTEN_FILE) )
+        elif entry_type in (DESC_OBSOLETE_MATCHED_FILE, DESC_OBSOLETE_WRITTEN_FILE):
+            return TemplateMatchedFile( offset, size,
+                                        jigdo_md5(buf[pos+6:pos+22]),
+                                        written = (entry_type == DESC_OBSOLETE_WRITTEN_FILE) )
+        elif entry_type == DESC_IMAGE_INFO:
+            return TemplateImageInfo( size,
+                                      jigdo_md5(buf[pos+6:pos+22]),
+                                      rsync_block_length = read_number(buf, pos+22, 4) )
+        return TemplateImageInfo(size, jigdo_md5(buf[pos+6:pos+22]))
+
+class JigdoImageAssembler:
+    """ Put an image together from its template and the files it is made of,
+        writing each file straight to its offset(s) in the image.
+
+        The image is built in image_location.part. Which files are in it is
+        kept in image_location.written, so an interrupted run can pick up
+        where it left off. """
+    def __init__(self, log, template_file, image_location):
+        self.log = log
+        self.template_file = template_file
+        self.location = image_location
+        self.part_location = "%s.part" % image_location
+        self.journal_location = "%s.written" % image_location
+        self.reader = JigdoTemplateReader(log, template_file)
+        self.image_info = None # TemplateImageInfo()
+        self.files = {} # {md5: [TemplateMatchedFile(),]}
+        self.written = {} # {md5: True}
+        self.unsynced = [] # md5s written, but not yet synced and journalled.
+        self.fd = None
+        self.journal = None
+
+    def open(self):
+        """ Read the template, create the (sparse) image and fill in the
+            template data, unless a previous run already did so. """
+        if self.fd is not None: return
+        unmatched = []
+        for record in self.reader.entries():
+            if isinstance(record, TemplateMatchedFile):
+                self.files.setdefault(record.md5, []).append(record)
+            elif isinstance(record, TemplateUnmatchedData):
+                unmatched.append(record)
+            else:
+                self.image_info = record
+        if not self.image_info:
+            raise TemplateError(_("%s has no image-info entry." % self.template_file))
+        resume = self.read_journal()
+        self.fd = os.open(self.part_location, os.O_RDWR | os.O_CREAT, 0644)
+        # Leave the image sparse, files are written as they arrive.
+        os.ftruncate(self.fd, self.image_info.size)
+        self.journal = open(self.journal_location, "a")
+        if resume:
+            self.log.info(_("Resuming %s, %s files already written." % \
+                           (self.part_location, len(self.written))))
+        else:
+            self.write_template_data(unmatched)
+            os.fsync(self.fd)
+            self.journal_add("template %s" % self.image_info.md5)
+
+    def read_journal(self):
+        """ Load what a previous run has written to the image. Return True
+            if the image and journal can be used. """
+        if not (os.access(self.part_location, os.W_OK) and \
+                os.access(self.journal_location, os.R_OK)):
+            self.remove_journal()
+            return False
+        f = open(self.journal_location, "r")
+        try:
+            lines = f.read().split("\n")
+        finally:
+            f.close()
+        if lines[0] != "template %s" % self.image_info.md5:
+            self.log.info(_("%s was started from a different template, starting over." % \
+                           self.part_location))
+            self.remove_journal()
+            return False
+        for md5 in lines[1:]:
+            if self.files.has_key(md5): self.written[md5] = True
+        return True
+
+    def remove_journal(self):
+        """ Remove any leftover journal. """
+        try:
+            os.unlink(self.journal_location)
+        except OSError:
+            pass
+
+    def journal_add(self, line):
+        """ Record line in the journal. """
+        self.journal.write("%s\n" % line)
+        self.journal.flush()
+
+    def sync(self):
+        """ Get the files added since the last sync onto disk, then record
+            them in the journal. The journal must never claim data that a
+            crash could still lose. """
+        if not self.unsynced: return
+        os.fsync(self.fd)
+        self.journal.write("".join(["%s\n" % md5 for md5 in self.unsynced]))
+        self.journal.flush()
+        self.unsynced = []
+
+    def write_at(self, offset, data):
+        """ Write data at offset in the image. """
+        os.lseek(self.fd, offset, 0)
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+
+    def write_template_data(self, unmatched):
+        """ Write the template data to the TemplateUnmatchedData entries. """
+        self.log.debug(_("Writing template data into %s ..." % self.part_location))
+        chunks = self.reader.data_chunks()
+        data = ""
+        pos = 0
+        for record in unmatched:
+            offset = record.offset
+            needed = record.size
+            while needed:
+                if pos >= len(data):
+                    try:
+                        data = chunks.next()
+                    except StopIteration:
+                        raise TemplateError(_("%s does not have enough template data." % \
+                                             self.template_file))
+                    pos = 0
+                piece = data[pos:pos + needed]
+                self.write_at(offset, piece)
+                pos += len(piece)
+                offset += len(piece)
+                needed -= len(piece)
+
+    def is_written(self, md5):
+        """ Return True if the file with md5 is already in the image. """
+        return self.written.has_key(md5)
+
+    def missing(self):
+        """ Return the md5 sums of the files not yet in the image. """
+        return [md5 for md5 in self.files.keys() if not self.written.has_key(md5)]
+
+    def add_file(self, md5, file, file_offset=0):
+        """ Copy the (verified) file with md5 to wherever the image needs it.
+            file_offset is where the data starts in file. It is journalled
+            on the next sync(). """
+        if not self.files.has_key(md5):
+            self.log.warning(_("%s is not part of %s." % (file, self.location)))
+            return False
+        if self.is_written(md5): return True
+        f = open(file, "rb")
+        try:
+            for record in self.files[md5]:
+                f.seek(file_offset)
+                offset = record.offset
+                needed = record.size
+                while needed:
+                    data = f.read(min(COPY_SIZE, needed))
+                    if not data:
+                        raise TemplateError(_("%s is shorter than expected." % file))
+                    self.write_at(offset, data)
+                    offset += len(data)
+                    needed -= len(data)
+        finally:
+            f.close()
+        self.written[md5] = True
+        self.unsynced.append(md5)
+        return True
+
+    def close(self):
+        """ Close the image and journal. """
+        if self.fd is not None:
+            self.sync()
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    def discard(self):
+        """ Throw away the image and journal, forgetting what was written. """
+        self.close()
+        try:
+            os.unlink(self.part_location)
+        except OSError:
+            pass
+        self.remove_journal()
+        self.written = {}
+
+    def finish(self):
+        """ If all files are in, check the image and move it into place.
+            Return True if the image is complete. """
+        if self.missing(): return False
+        self.close()
+        if not check_hash(self.log, self.part_location, self.image_info.md5):
+            self.log.critical(_("%s was put together, but does not match its template!" % \
+                               self.part_location))
+            # The journal would claim every file is in, drop both so
+            # the next run builds the image again.
+            self.discard()
+            return False
+        os.rename(self.part_location, self.location)
+        self.remove_journal()
+        return True
@@ -19,7 +19,7 @@
 Utility functions, shared across classes.
 """
 
-import os, re, base64, time, subprocess
+import os, re, base64, subprocess
 
 from urlparse import urlparse
 
@@ -34,6 +34,7 @@ from pyJigdo.translate import _, N_
 
 eq = re.compile('=')
 B, K, M, G = 1, 1024, 1024*1024, 1024*1024*1024
+hash_cache = None # HashCache(), see set_hash_cache()
 
 def image_numstr_to_list(image_numstr):
     """ Expand a comma-separated list of image numbers and ranges into a list.
@@ -89,46 +90,161 @@ def check_complete(log, file, hash):
         log.debug(_("File %s is not complete. Marking for re-download." % file))
     return False
 
+def jigdo_md5(md5_digest):
+    """ Return the given raw md5 digest in the base64 form jigdo uses. """
+    return eq.sub('', base64.urlsafe_b64encode(md5_digest))
+
+def set_hash_cache(cache):
+    """ Use the given HashCache() in check_hash(), None disables caching. """
+    global hash_cache
+    hash_cache = cache
+
+def close_hash_cache(log):
+    """ Report on and close the HashCache() in use, if any. """
+    if hash_cache:
+        log.info(str(hash_cache))
+        hash_cache.close()
+        set_hash_cache(None)
+
+def file_hash(log, file, offset=0, size=None):
+    """ Return the jigdo md5 sum of file, or None if it can't be read.
+        If size is given, only hash size bytes starting at offset. """
+    whole_file = not offset and size is None
+    if hash_cache and whole_file:
+        cached_hash = hash_cache.lookup(file)
+        if cached_hash: return cached_hash
+    bufsize = 8*K*B
+    mode = 'rb'
+    try:
+        st = os.stat(file)
+        f = open(file, mode)
+        f.seek(offset)
+        remaining = size
+        md5 = md5_hashlib.md5()
+        while remaining is None or remaining > 0:
+            if remaining is None: d = f.read(bufsize)
+            else: d = f.read(min(bufsize, remaining))
+            if not d: break
+            if remaining is not None: remaining -= len(d)
+            md5.update(d)
+        f.close()
+        if remaining:
+            log.warning(_("File %s is shorter than expected." % file))
+            return None
+        md5_hash = jigdo_md5(md5.digest())
+    except Exception, e:
+        log.warning(_("Reading file %s failed: %s" % (file, e)))
+        return None
+    if hash_cache and whole_file: hash_cache.store(file, md5_hash, st)
+    return md5_hash
+
+def partial_hash(log, file):
+    """ Return (md5, size) for the data already in file, md5 being a
+        running md5 object that more data can be added to. """
+    bufsize = 8*K*B
+    md5 = md5_hashlib.md5()
+    size = 0
+    f = open(file, 'rb')
+    try:
+        while True:
+            d = f.read(bufsize)
+            if not d: break
+            md5.update(d)
+            size += len(d)
+    finally:
+        f.close()
+    return (md5, size)
+
+def remove_file(log, file):
+    """ Remove file if it is there, so it is fetched again from scratch. """
+    try:
+        os.remove(file)
+        log.debug(_("Removed %s" % file))
+    except OSError:
+        pass
+
+def read_validators(log, file, url):
+    """ Return the HTTP validators ({header: value}, such as ETag and
+        Last-Modified) saved with save_validators() for file. Nothing
+        is returned if file itself is not there, or it was not
+        downloaded from url. """
+    validators = {}
+    if not os.path.isfile(file): return validators
+    try:
+        f = open("%s.validators" % file, 'r')
+        try:
+            for line in f:
+                if ':' not in line: continue
+                (name, value) = line.split(':', 1)
+                validators[name.strip()] = value.strip()
+        finally:
+            f.close()
+    except IOError:
+        pass
+    if validators.pop("URL", None) != url: return {}
+    return validators
+
+def save_validators(log, file, url, validators):
+    """ Save the HTTP validators of the response file was downloaded from
+        url, so the next request for it can be conditional. """
+    try:
+        f = open("%s.validators" % file, 'w')
+        try:
+            f.write("URL: %s\n" % url)
+            for (name, value) in validators.items():
+                f.write("%s: %s\n" % (name, value))
+        finally:
+            f.close()
+    except IOError, e:
+        log.warning(_("Could not save validators for %s: %s" % (file, e)))
+
+def copy_extent(log, file, offset, size, target):
+    """ Copy size bytes starting at offset in file to target. """
+    bufsize = 8*K*B
+    check_directory(log, os.path.dirname(target))
+    f = open(file, 'rb')
+    try:
+        out = open(target, 'wb')
+        try:
+            f.seek(offset)
+            remaining = size
+            while remaining > 0:
+                d = f.read(min(bufsize, remaining))
+                if not d: raise IOError(_("%s ended early." % file))
+                out.write(d)
+                remaining -= len(d)
+        finally:
+            out.close()
+    finally:
+        f.close()
+
+def check_download(log, file, hash, file_hash_value):
+    """ See if the sum taken while downloading file matches given hash.
+        If it does, remember it so the file is not re-read later. """
+    log.debug(_("Checking %s against %s for %s ..." % \
+               (file_hash_value, hash, file)))
+    if file_hash_value != hash: return False
+    if hash_cache: hash_cache.store(file, file_hash_value)
+    return True
+
 def check_hash(log, file, hash):
     """ Hash a file and see if it matches given hash. """
     matches = False
     if os.path.isfile(file):
-        bufsize = 8*K*B
-        mode = 'rb'
-        try:
-            f = open(file, mode)
-            md5 = md5_hashlib.md5()
-            while True:
-                d = f.read(bufsize)
-                if not d:
-                    f.close()
-                    break
-                md5.update(d)
-            md5_digest = md5.digest()
-            base64_md5_digest = base64.urlsafe_b64encode(md5_digest)
-            file_hash = eq.sub('', base64_md5_digest)
-            log.debug(_("Checking %s against %s for %s ..." % \
-                       (file_hash, hash, file)))
-            if file_hash == hash: matches = True
-        except Exception, e:
-            log.warning(_("Reading file %s failed: %s" % (file, e)))
+        file_hash_value = file_hash(log, file)
+        log.debug(_("Checking %s against %s for %s ..." % \
+                   (file_hash_value, hash, file)))
+        if file_hash_value == hash: matches = True
     return matches
 
 def run_command(log, settings, command, rundir=None, inshell=False, env=None, stdout=subprocess.PIPE):
     """ Run a command and return output. Remember command must be ['command', 'arg1', 'arg2'] """
-    ret = []
     if not rundir: rundir = settings.download_storage
     check_directory(log, rundir)
     if not env: env = {'PATH': os.getenv('PATH')}
     if not command: return ""
     log.debug(_("Running command: '%s'" % " ".join(command)))
     p = subprocess.Popen(command, cwd=rundir, stdout=stdout, stderr=subprocess.STDOUT, shell=False, env=env)
-    while p.poll() == None:
-        for item in p.stdout.read().split('\n'):
-            ret.append(item)
-        time.sleep(0.01)
-    for item in p.stdout.read().split('\n'):
-        ret.append(item)
-    p.stdout.close()
-    return ret
-
+    # Wait for the command to exit, instead of polling for it.
+    output = p.communicate()[0] or ""
+    return output.split('\n')
@@ -70,10 +70,24 @@ class PyJigdo:
         default_fallback = 3
         default_max_attempts = 6
         default_timeout = 30
+        default_min_speed = 1
+        default_min_speed_time = 60
+        default_hedge_after = 10
+        default_host_limit = 0
+        default_rate_limit = 0
         default_threads = 8
+        default_min_threads = 2
+        default_max_threads = 32
         default_stuff_bits = default_threads*10
         default_stuff_then_remove = False
         default_jigdo_file_location = "/usr/bin/jigdo-file"
+        default_hash_cache_size = 100000
+        default_hash_workers = 4
+        default_slice_order = "fifo"
+        default_idle_connections = 4
+        default_idle_timeout = 30
+        default_segments = 4
+        default_segment_size = 8
 
         ##
         ## Runtime Options
@@ -84,6 +98,11 @@ class PyJigdo:
                                   action  = "store",
                                   default = default_jigdo_file_location,
                                   help    = _("Use given jigdo-file binary. (Default: %s)" % default_jigdo_file_location))
+        runtime_group.add_option( "--jigdo-file-assembly",
+                                  dest    = "jigdo_file_assembly",
+                                  action  = "store_true",
+                                  default = False,
+                                  help    = _("Use jigdo-file to put images together instead of the built in assembler."))
         runtime_group.add_option( "--list-images",
                                   dest    = "list_images",
                                   action  = "store_true",
@@ -140,7 +159,28 @@ class PyJigdo:
                                     action  = "store",
                                     default = default_timeout,
                                     type    = 'float',
-                                    help    = _("Number of seconds to wait before switching to different slice source. (Default: %s)" % default_timeout),
+                                    help    = _("Number of seconds to wait for a connection or for data before switching to different slice source. (Default: %s)" % default_timeout),
+                                    metavar = _("[number of seconds]"))
+        general_group.add_option(   "--min-speed",
+                                    dest    = "min_speed",
+                                    action  = "store",
+                                    default = default_min_speed,
+                                    type    = 'float',
+                                    help    = _("Switch to different slice source when a download is slower than this many KB/s for --min-speed-time seconds, 0 to disable. (Default: %s)" % default_min_speed),
+                                    metavar = _("[KB/s]"))
+        general_group.add_option(   "--min-speed-time",
+                                    dest    = "min_speed_time",
+                                    action  = "store",
+                                    default = default_min_speed_time,
+                                    type    = 'float',
+                                    help    = _("Number of seconds a download may be slower than --min-speed. (Default: %s)" % default_min_speed_time),
+                                    metavar = _("[number of seconds]"))
+        general_group.add_option(   "--hedge-after",
+                                    dest    = "hedge_after",
+                                    action  = "store",
+                                    default = default_hedge_after,
+                                    type    = 'float',
+                                    help    = _("When nothing else is left to download, race files downloading for longer than this many seconds with a second copy from a different slice source, 0 to disable. (Default: %s)" % default_hedge_after),
                                     metavar = _("[number of seconds]"))
 
         ## Downloading Options
@@ -171,9 +211,80 @@ class PyJigdo:
                                     dest    = "download_threads",
                                     action  = "store",
                                     default = default_threads,
-                                    help    = _("Number of threads to use when downloading. (Default: %s)" % default_threads),
+                                    help    = _("Number of threads to use when downloading, or auto to tune it between --min-threads and --max-threads as downloads go. (Default: %s)" % default_threads),
+                                    type    = "str",
+                                    metavar = _("[number|auto]"))
+        download_group.add_option(  "--min-threads",
+                                    dest    = "min_threads",
+                                    action  = "store",
+                                    default = default_min_threads,
+                                    help    = _("Least number of threads to use with --threads auto. (Default: %s)" % default_min_threads),
                                     type    = "int",
                                     metavar = _("[number]"))
+        download_group.add_option(  "--max-threads",
+                                    dest    = "max_threads",
+                                    action  = "store",
+                                    default = default_max_threads,
+                                    help    = _("Most number of threads to use with --threads auto. (Default: %s)" % default_max_threads),
+                                    type    = "int",
+                                    metavar = _("[number]"))
+        download_group.add_option(  "--slice-order",
+                                    dest    = "slice_order",
+                                    action  = "store",
+                                    default = default_slice_order,
+                                    help    = _("Order to download slices in, one of: %s. (Default: %s)" % (", ".join(SLICE_ORDERS), default_slice_order)),
+                                    type    = "choice",
+                                    choices = SLICE_ORDERS,
+                                    metavar = _("[order]"))
+        download_group.add_option(  "--host-limit",
+                                    dest    = "host_limit",
+                                    action  = "store",
+                                    default = default_host_limit,
+                                    help    = _("Max number of files to download from one host at once, 0 for no limit. (Default: %s)" % default_host_limit),
+                                    type    = "int",
+                                    metavar = _("[number]"))
+        download_group.add_option(  "--repo-limit",
+                                    dest    = "repo_limits",
+                                    default = [],
+                                    action  = "append",
+                                    type    = "str",
+                                    help    = _("Max number of files to download at once from the repo with the given label. e.g.: \"Fedora-Updates:2\""),
+                                    metavar = _("[label:number]"))
+        download_group.add_option(  "--rate-limit",
+                                    dest    = "rate_limit",
+                                    action  = "store",
+                                    default = default_rate_limit,
+                                    help    = _("Max total download speed in KB/s, 0 for no limit. (Default: %s)" % default_rate_limit),
+                                    type    = "float",
+                                    metavar = _("[KB/s]"))
+        download_group.add_option(  "--idle-connections",
+                                    dest    = "idle_connections",
+                                    action  = "store",
+                                    default = default_idle_connections,
+                                    help    = _("Number of idle connections to keep open to each host for reuse. This does not limit downloads, see --host-limit. (Default: %s)" % default_idle_connections),
+                                    type    = "int",
+                                    metavar = _("[number]"))
+        download_group.add_option(  "--idle-timeout",
+                                    dest    = "idle_timeout",
+                                    action  = "store",
+                                    default = default_idle_timeout,
+                                    help    = _("Seconds to keep an idle connection open for reuse. (Default: %s)" % default_idle_timeout),
+                                    type    = "int",
+                                    metavar = _("[seconds]"))
+        download_group.add_option(  "--segments",
+                                    dest    = "download_segments",
+                                    action  = "store",
+                                    default = default_segments,
+                                    help    = _("Max number of mirrors to fetch parts of one large file from at once, 1 to disable. (Default: %s)" % default_segments),
+                                    type    = "int",
+                                    metavar = _("[number]"))
+        download_group.add_option(  "--segment-size",
+                                    dest    = "segment_size",
+                                    action  = "store",
+                                    default = default_segment_size,
+                                    help    = _("Smallest part of a file to fetch from one mirror, in megabytes. (Default: %s)" % default_segment_size),
+                                    type    = "int",
+                                    metavar = _("[megabytes]"))
         download_group.add_option(  "--stuff-bits",
                                     dest    = "download_stuff_bits",
                                     action  = "store",
@@ -192,6 +303,30 @@ class PyJigdo:
                                     default = default_work,
                                     help    = _("Directory to store any temporary data for downloads. (Default: %s)" % default_work),
                                     metavar = _("[directory]"))
+        download_group.add_option(  "--no-hash-cache",
+                                    dest    = "no_hash_cache",
+                                    action  = "store_true",
+                                    default = False,
+                                    help    = _("Don't keep a cache of file sums in the download storage directory. (Default: False)"))
+        download_group.add_option(  "--no-jigdo-cache",
+                                    dest    = "no_jigdo_cache",
+                                    action  = "store_true",
+                                    default = False,
+                                    help    = _("Don't keep the parsed jigdo file in the download storage directory, parse it every run. (Default: False)"))
+        download_group.add_option(  "--hash-cache-size",
+                                    dest    = "hash_cache_size",
+                                    action  = "store",
+                                    default = default_hash_cache_size,
+                                    help    = _("Max number of file sums to keep in the hash cache. (Default: %s)" % default_hash_cache_size),
+                                    type    = "int",
+                                    metavar = _("[number]"))
+        download_group.add_option(  "--hash-workers",
+                                    dest    = "hash_workers",
+                                    action  = "store",
+                                    default = default_hash_workers,
+                                    help    = _("Number of threads to use when checking existing files. (Default: %s)" % default_hash_workers),
+                                    type    = "int",
+                                    metavar = _("[number]"))
         download_group.add_option(  "--download-target",
                                     dest    = "download_target",
                                     action  = "store",
@@ -220,12 +355,22 @@ class PyJigdo:
                                     default = [],
                                     help    = _("Scan given directory for files needed by selected image(s)."),
                                     metavar = _("[directory]"))
+        scan_group.add_option(      "--scan-content",
+                                    dest    = "scan_by_content",
+                                    action  = "store_true",
+                                    default = False,
+                                    help    = _("Match scanned files by size and sum, wherever they are, instead of by path. (Default: False)"))
+        scan_group.add_option(      "--no-scan-index",
+                                    dest    = "no_scan_index",
+                                    action  = "store_true",
+                                    default = False,
+                                    help    = _("Don't keep an index of scanned directories in the download storage directory, walk and sum them every run. (Default: False)"))
         scan_group.add_option(      "--scan-iso",
                                     dest    = "scan_isos",
                                     action  = "append",
                                     type    = "str",
                                     default = [],
-                                    help    = _("Mount and then scan existing ISO images for files needed by selected image(s)."),
+                                    help    = _("Scan existing ISO images (without mounting them) for files needed by selected image(s)."),
                                     metavar = _("[iso image]"))
 
         # Parse Options, preserve the object for later use
@@ -252,6 +397,12 @@ class PyJigdo:
             if self.cli_options.image_filenames:
                 self.shell_escape_help()
             sys.exit(1)
+        if str(self.cli_options.download_threads) != "auto":
+            try:
+                int(self.cli_options.download_threads)
+            except ValueError:
+                print _("--threads must be a number or auto, not %s." % self.cli_options.download_threads)
+                sys.exit(1)
         return True
 
     def show_help(self):
@@ -289,8 +440,8 @@ if __name__ == "__main__":
     return_code = 0
     pyJigdo_interface = PyJigdo()
     pyJigdo_interface.base.run()
-    if pyJigdo_interface.base.async.pending_downloads:
-        pyJigdo_interface.base.async.checkpoint(None)
+    if pyJigdo_interface.base.async.has_work():
+        pyJigdo_interface.base.async.start()
         try:
             return_code = pyJigdo_interface.base.async.reactor.run()
         except KeyboardInterrupt:
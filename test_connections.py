@@ -0,0 +1,206 @@
+#!/bin/env python
+# Test downloads against a local twisted.web stand-in for a mirror: that
+# they reuse connections to a host, and that conditional downloads are
+# answered with a 304. Prints requests per second with and without
+# connection reuse.
+
+import os, sys, shutil, tempfile, time
+
+from twisted.internet import reactor, defer
+from twisted.python.failure import Failure
+from twisted.web import http
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from twisted.web.static import File
+
+from pyJigdo.pyasync import PyJigdoReactor, TransferAborted
+from pyJigdo.util import jigdo_md5, md5_hashlib
+
+from test_helpers import Log
+
+FILES = 200
+FILE_SIZE = 20 * 1024
+WORKERS = 4
+
+def download_all(async, base_url, target, sums):
+    """ Download every file with WORKERS downloads running at once.
+        The Deferred fires with (requests per second, files that matched). """
+    matched = []
+    def check(digest, i):
+        if digest == sums[i]: matched.append(i)
+    def worker(first):
+        d = defer.succeed(None)
+        for i in range(first, FILES, WORKERS):
+            d.addCallback(lambda ign, i=i: async.download_file( "%sf%s" % (base_url, i),
+                                                                os.path.join(target, "f%s" % i) ))
+            d.addCallback(check, i)
+        return d
+    started = time.time()
+    d = defer.DeferredList([worker(n) for n in range(WORKERS)], fireOnOneErrback=True)
+    d.addCallback(lambda ign: (FILES / (time.time() - started), len(matched)))
+    return d
+
+def test_connection_reuse():
+    """ Pooled downloads are correct and share a few connections.
+        Runs in the reactor, the Deferred fires once it is done. """
+    served = tempfile.mkdtemp()
+    target = tempfile.mkdtemp()
+    results = {}
+    sums = {}
+    for i in range(FILES):
+        data = os.urandom(FILE_SIZE)
+        open(os.path.join(served, "f%s" % i), "wb").write(data)
+        sums[i] = jigdo_md5(md5_hashlib.md5(data).digest())
+    port = reactor.listenTCP(0, Site(File(served)), interface="127.0.0.1")
+    base_url = "http://127.0.0.1:%s/" % port.getHost().port
+    pooled = PyJigdoReactor(Log(), idle_connections=WORKERS)
+    unpooled = PyJigdoReactor(Log())
+    unpooled.agent = None
+    unpooled.pool = None
+
+    def check(ign):
+        if not pooled.agent:
+            print "twisted has no HTTPConnectionPool, nothing to compare."
+            return
+        print "with reuse: %.0f requests/s, %s" % (results["pooled"][0], pooled.connection_stats())
+        print "without reuse: %.0f requests/s" % results["unpooled"][0]
+        assert results["pooled"][1] == FILES, results["pooled"]
+        assert results["unpooled"][1] == FILES, results["unpooled"]
+        assert pooled.requests_made == FILES, pooled.requests_made
+        assert pooled.pool.connections_made <= WORKERS, pooled.pool.connections_made
+
+    def cleanup(result):
+        shutil.rmtree(served)
+        shutil.rmtree(target)
+        for async in (pooled, unpooled): async.hasher.stop()
+        return result
+
+    d = download_all(pooled, base_url, target, sums)
+    d.addCallback(lambda result: results.__setitem__("pooled", result))
+    d.addCallback(lambda ign: download_all(unpooled, base_url, target, sums))
+    d.addCallback(lambda result: results.__setitem__("unpooled", result))
+    d.addCallback(lambda ign: pooled.pool and pooled.pool.closeCachedConnections())
+    d.addBoth(lambda result: defer.maybeDeferred(port.stopListening).addCallback(lambda ign: result))
+    d.addBoth(cleanup)
+    d.addCallback(check)
+    return d
+
+class Validated(Resource):
+    """ A file with an ETag and a Last-Modified date, that answers
+        conditional requests for it with a 304. """
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.requests = [] # [(If-None-Match, If-Modified-Since) of each request]
+        self.change("first version")
+
+    def change(self, data):
+        """ Serve data from now on, with a new ETag and date. """
+        self.data = data
+        self.etag = md5_hashlib.md5(data).hexdigest()
+        self.last_modified = time.time() - 3600 + len(self.requests)
+
+    def render_GET(self, request):
+        self.requests.append((request.getHeader("if-none-match"),
+                              request.getHeader("if-modified-since")))
+        request.setLastModified(self.last_modified)
+        # An ETag that does not match wins over the date.
+        if request.setETag(self.etag) == http.CACHED: return ""
+        request.setResponseCode(http.OK)
+        return self.data
+
+def conditional_downloads(async, base_url, target, root):
+    """ Fetch "first" from root, fetch it again unchanged, then changed,
+        and then fetch "second" to the same file.
+        Fires with [(sum, data in file, conditional headers sent)]. """
+    file = os.path.join(target, "validated")
+    steps = []
+    def fetch(ign, name):
+        d = async.download_file(base_url + name, file, conditional=True)
+        d.addCallback(lambda digest: steps.append((digest, open(file, "rb").read(),
+                                                   root.children[name].requests[-1])))
+        return d
+    for name in ("first", "second"): root.putChild(name, Validated())
+    d = fetch(None, "first")
+    d.addCallback(fetch, "first")
+    d.addCallback(lambda ign: root.children["first"].change("second version"))
+    d.addCallback(fetch, "first")
+    d.addCallback(fetch, "second")
+    d.addCallback(lambda ign: steps)
+    return d
+
+def test_conditional_download():
+    """ An unchanged file is answered with a 304 and kept, a changed ETag
+        fetches it again, and validators are only sent to the url they
+        came from. Runs in the reactor, the Deferred fires once it is done. """
+    target = tempfile.mkdtemp()
+    root = Resource()
+    port = reactor.listenTCP(0, Site(root), interface="127.0.0.1")
+    base_url = "http://127.0.0.1:%s/" % port.getHost().port
+    pooled = PyJigdoReactor(Log())
+    unpooled = PyJigdoReactor(Log())
+    unpooled.agent = None
+    unpooled.pool = None
+    first_sum = jigdo_md5(md5_hashlib.md5("first version").digest())
+    second_sum = jigdo_md5(md5_hashlib.md5("second version").digest())
+
+    def check(steps):
+        (fetched, unchanged, changed, elsewhere) = steps
+        assert fetched[:2] == (first_sum, "first version"), fetched
+        assert fetched[2] == (None, None), fetched
+        assert unchanged[:2] == (None, "first version"), unchanged
+        assert unchanged[2][0] == md5_hashlib.md5("first version").hexdigest(), unchanged
+        assert unchanged[2][1], unchanged
+        assert changed[:2] == (second_sum, "second version"), changed
+        assert elsewhere[:2] == (first_sum, "first version"), elsewhere
+        assert elsewhere[2] == (None, None), elsewhere
+
+    def run(ign, async):
+        d = conditional_downloads(async, base_url, target, root)
+        d.addCallback(check)
+        return d
+
+    def cleanup(result):
+        shutil.rmtree(target)
+        for async in (pooled, unpooled):
+            if async.pool: async.pool.closeCachedConnections()
+            async.hasher.stop()
+        return defer.maybeDeferred(port.stopListening).addCallback(lambda ign: result)
+
+    d = run(None, pooled)
+    d.addCallback(run, unpooled)
+    d.addBoth(cleanup)
+    return d
+
+def test_race_loss_is_not_a_failure():
+    """ The copy that loses a race is not held against its mirror. """
+    async = PyJigdoReactor(Log())
+    url = "http://mirror.example.com/f0"
+    for reason in ["raced", "stalled"]:
+        mirror = async.mirror_stats.get(url)
+        failure = Failure(TransferAborted(url, reason))
+        async.download_measure_failure(failure, mirror, mirror.start())
+        assert mirror.active == 0, mirror.active
+    assert mirror.errors == 1, mirror.errors
+    async.hasher.stop()
+
+def run_in_reactor(tests):
+    """ Run the tests returning Deferreds one after the other, in a
+        single run of the reactor. Raise the first failure. """
+    failures = []
+    def run():
+        d = defer.succeed(None)
+        for test in tests:
+            d.addCallback(lambda ign, test=test: test())
+            d.addCallback(lambda ign, test=test: sys.stdout.write("%s: ok\n" % test.__name__))
+        d.addErrback(failures.append)
+        d.addBoth(lambda ign: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
+    if failures: failures[0].raiseException()
+
+if __name__ == "__main__":
+    test_race_loss_is_not_a_failure()
+    print "test_race_loss_is_not_a_failure: ok"
+    run_in_reactor([test_conditional_download, test_connection_reuse])
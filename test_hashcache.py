@@ -0,0 +1,35 @@
+#!/bin/env python
+# Test the persistent hash cache.
+
+import os, shutil, tempfile
+
+from pyJigdo.hashcache import HashCache
+
+from test_helpers import Log
+
+def test_store_counts_new_entries():
+    """ Storing the same file again does not grow the cache. """
+    target = tempfile.mkdtemp()
+    try:
+        files = []
+        for i in range(3):
+            name = os.path.join(target, "file%s" % i)
+            open(name, "w").write("data %s" % i)
+            files.append(name)
+        cache = HashCache(Log(), os.path.join(target, "hashcache.db"))
+        for name in files + files + files[:1]:
+            cache.store(name, "md5-of-%s" % os.path.basename(name))
+        assert cache.entries == 3, cache.entries
+        assert cache.lookup(files[0]) == "md5-of-file0"
+        cache.close()
+        cache = HashCache(Log(), os.path.join(target, "hashcache.db"))
+        assert cache.entries == 3, cache.entries
+        cache.close()
+    finally:
+        shutil.rmtree(target)
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print "%s: ok" % name
@@ -0,0 +1,83 @@
+#!/bin/env python
+# Test the .jigdo definition parser on test_data/test.jigdo.
+
+import os, shutil, tempfile
+
+from pyJigdo.jigdo import JigdoDefinition
+
+from test_helpers import Log
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+JIGDO = os.path.join(TEST_DATA, "test.jigdo")
+
+class Settings:
+    """ The settings the parser looks at. """
+    no_jigdo_cache = True
+    download_target = TEST_DATA
+
+class SlowPartsDefinition(JigdoDefinition):
+    """ Parse [Parts] like any other section. """
+    parts_fast_path = False
+
+def parse(definition_class=JigdoDefinition, settings=None):
+    """ Return the parsed test jigdo. """
+    return definition_class(None, Log(), settings or Settings(), JIGDO, just_print=True)
+
+def other_sections(definition):
+    """ Return the parsed options of the sections other than [Parts]. """
+    return [(name, options) for (name, options) in definition.section_options
+            if name != "Parts"]
+
+def test_parts():
+    """ [Parts] values are read the way RawConfigParser reads them. """
+    parts = parse().parts
+    assert len(parts) == 8, dict(parts.iteritems())
+    assert parts["Cn6M02H9Vp8h2KjzWf7VEQ"] == "Fedora:Packages/beta-2.1-3.noarch.rpm"
+    assert parts["kd3-rseHbq4_5GHqeF-ZeQ"] == "Updates:gamma-0.9-1.noarch.rpm"
+    assert parts["_aw1c4Hn2Jh7IC2n3HSqzw"] == "Fedora:Packages/with;semicolon.rpm"
+    assert parts["rB8ty5FtjyrVjX4pvd0BwA"] == "Fedora:Packages/r-starts-with-r.rpm"
+    assert parts["-Q9aB7lG0kPz1W8mEe3rTg"] == ""
+    assert parts["AbCdEfGhIjKlMnOpQrStUv"] == "Fedora:Packages/split-\nover-two-lines.rpm"
+    assert parts.part("kd3-rseHbq4_5GHqeF-ZeQ") == ("Updates", "gamma-0.9-1.noarch.rpm")
+    # Every label is kept once.
+    assert sorted(parts.labels) == [None, "Fedora", "Updates"], parts.labels
+
+def test_image():
+    """ The [Image] section is read, continuation lines included. """
+    image = parse().images[1]
+    assert image.filename == "test.iso"
+    assert image.template_md5sum == "8h_CCZbVoPiSsbQWKYqvVQ"
+    assert image.info == "An image\ndescribed over two lines", repr(image.info)
+
+def test_fast_path_matches_slow_path():
+    """ The [Parts] fast path gives the same result as the general one. """
+    fast = parse()
+    slow = parse(SlowPartsDefinition)
+    assert dict(fast.parts.iteritems()) == dict(slow.parts.iteritems())
+    assert other_sections(fast) == other_sections(slow)
+    assert fast.servers.i == slow.servers.i
+
+def test_cache():
+    """ A definition loaded from the cache is the same as a parsed one. """
+    storage = tempfile.mkdtemp()
+    try:
+        settings = Settings()
+        settings.no_jigdo_cache = False
+        settings.download_storage = storage
+        parsed = parse(settings=settings)
+        assert os.path.exists(os.path.join(storage, "test.jigdo.parsed"))
+        cached = parse(settings=settings)
+        assert dict(cached.parts.iteritems()) == dict(parsed.parts.iteritems())
+        assert cached.servers.i == parsed.servers.i
+        assert cached.section_options == parsed.section_options
+        assert [s.__class__ for s in cached._sections] == \
+               [s.__class__ for s in parsed._sections]
+        assert cached.images[1].template_md5sum == parsed.images[1].template_md5sum
+    finally:
+        shutil.rmtree(storage)
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print "%s: ok" % name
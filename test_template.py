@@ -0,0 +1,106 @@
+#!/bin/env python
+# Test the native jigdo template reader against test_data/test.template,
+# a small template with known DESC entries.
+
+import os, shutil, tempfile
+
+from pyJigdo.template import *
+
+from test_helpers import Log
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+TEMPLATE = os.path.join(TEST_DATA, "test.template")
+
+PARTS = { "PmLo-Krx-Zg6Ptc3WjF-Hg": "alpha-1.0-1.noarch.rpm",
+          "Cn6M02H9Vp8h2KjzWf7VEQ": "beta-2.1-3.noarch.rpm",
+          "kd3-rseHbq4_5GHqeF-ZeQ": "gamma-0.9-1.noarch.rpm" }
+
+EXPECTED_ENTRIES = [ "in-template 0 420",
+                     "need-file 420 880 PmLo-Krx-Zg6Ptc3WjF-Hg",
+                     "in-template 1300 126",
+                     "need-file 1426 3150 Cn6M02H9Vp8h2KjzWf7VEQ",
+                     "in-template 4576 264",
+                     "need-file 4840 66 kd3-rseHbq4_5GHqeF-ZeQ",
+                     "image-info 4906 8h_CCZbVoPiSsbQWKYqvVQ 1024" ]
+
+def test_entries():
+    """ The DESC table is read into the expected records. """
+    reader = JigdoTemplateReader(Log(), TEMPLATE)
+    entries = [str(record) for record in reader.entries()]
+    assert entries == EXPECTED_ENTRIES, entries
+
+def test_data_chunks():
+    """ The template data is as long as the in-template entries. """
+    reader = JigdoTemplateReader(Log(), TEMPLATE)
+    data = "".join(reader.data_chunks())
+    assert len(data) == 420 + 126 + 264, len(data)
+    assert data.startswith("ISO9660 header stuff\n")
+
+def test_not_a_template():
+    """ Anything without a DESC table is refused. """
+    reader = JigdoTemplateReader(Log(), os.path.abspath(__file__))
+    try:
+        list(reader.entries())
+    except TemplateError:
+        return
+    raise AssertionError("%s was read as a template" % __file__)
+
+def assemble(image):
+    """ Put image together from the test template and parts. """
+    assembler = JigdoImageAssembler(Log(), TEMPLATE, image)
+    assembler.open()
+    for md5, name in PARTS.items():
+        assembler.add_file(md5, os.path.join(TEST_DATA, name))
+    return assembler
+
+def test_assemble():
+    """ The image is put together and moved into place. """
+    target = tempfile.mkdtemp()
+    try:
+        image = os.path.join(target, "test.iso")
+        assert assemble(image).finish()
+        assert os.path.getsize(image) == 4906
+        assert not os.path.exists("%s.written" % image)
+    finally:
+        shutil.rmtree(target)
+
+def test_journal_after_sync():
+    """ Files only reach the journal once they have been synced. """
+    target = tempfile.mkdtemp()
+    try:
+        image = os.path.join(target, "test.iso")
+        assembler = assemble(image)
+        journal = "%s.written" % image
+        assert open(journal).read().split("\n")[1:] == [""]
+        assembler.sync()
+        assert sorted(open(journal).read().split()[2:]) == sorted(PARTS.keys())
+        assembler.close()
+        resumed = JigdoImageAssembler(Log(), TEMPLATE, image)
+        resumed.open()
+        assert len(resumed.written) == len(PARTS)
+        assert resumed.finish()
+    finally:
+        shutil.rmtree(target)
+
+def test_assemble_repairs_corruption():
+    """ A corrupted image is thrown away, so the next run rebuilds it. """
+    target = tempfile.mkdtemp()
+    try:
+        image = os.path.join(target, "test.iso")
+        assembler = assemble(image)
+        # Damage the data written for beta.
+        assembler.write_at(1500, "corrupt")
+        assert not assembler.finish()
+        assert not os.path.exists("%s.part" % image)
+        assert not os.path.exists("%s.written" % image)
+        assembler = assemble(image)
+        assert assembler.finish()
+        assert os.path.exists(image)
+    finally:
+        shutil.rmtree(target)
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print "%s: ok" % name